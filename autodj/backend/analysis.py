@@ -1,47 +1,84 @@
 import logging
-from typing import List, Tuple
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Optional
 
 import numpy as np
 import scipy.fft
-import scipy.interpolate
 import scipy.ndimage
 import scipy.signal
-import scipy.signal
 import scipy.spatial
 
 from autodj.backend.audio import AudioFile
 
+# Increase whenever the results of the analysis change to invalidate caches
+ANALYSIS_VERSION = 4
+
+# Length of the analyzed windows (in seconds), which is also the unit of the
+# spectrum in which the BPM is detected
+WINDOW = 60
+# Fraction by which consecutive windows of the tempo map overlap
+SEGMENT_OVERLAP = 0.5
+# Maximum relative deviation of the local tempo from the song's BPM
+MAX_TEMPO_DEVIATION = 0.05
+# Maximum distance (in beats) by which a bar is moved onto the beat grid
+SNAP = 0.25
+
+KEY_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+# Krumhansl-Kessler key profiles starting at the tonic
+MAJOR_PROFILE = np.asarray(
+    [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.asarray(
+    [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+
+# Worker processes that analyze the windows of the tempo maps
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
 
-def add_pw_functions(x1: List[float], y1: List[float], x2: List[float],
-        y2: List[float]) -> Tuple[List[float], List[float]]:
+def harmonic_sum(f: np.ndarray, max_harmonics: int, lo: float,
+        hi: float) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Adds two piecewise linear functions.
+    Sums the spectrum `f` compressed by the factors 1 to `max_harmonics`
+    (i.e., `f` sampled at multiples of x). Returns the union of all sample
+    positions between `lo` and `hi` and the linearly interpolated sum at
+    these positions.
     """
-    a = scipy.interpolate.interp1d(x1, y1, fill_value=(0, 0),
-        bounds_error=False)
-    if x2.shape[0] > 0:
-        b = scipy.interpolate.interp1d(x2, y2, fill_value=(0, 0),
-            bounds_error=False)
-    else:
-        b = lambda x: 0
-    abx = np.unique(np.concatenate((x1, x2)))
-    ab = a(abx) + b(abx)
-    ab = scipy.interpolate.interp1d(abx, ab, fill_value=(0, 0),
-        bounds_error=False)
-    return np.asarray(abx), np.asarray(ab(abx))
+    n = f.shape[0]
+    k = np.arange(n)
+    grid = [k[int(np.ceil(lo * d)):min(int(np.floor(hi * d)) + 1, n)] / d
+            for d in range(1, max_harmonics + 1)]
+    x = np.unique(np.concatenate(grid))
+    y = np.zeros_like(x)
+    for d in range(1, max_harmonics + 1):
+        y += np.interp(x, k / d, f, left=0, right=0)
+    return x, y
 
 
-def normalize(x):
+def nearest(t: np.ndarray, x: np.ndarray) -> np.ndarray:
     """
-    Subtracts the trend based on a 2nd degree polynomial and normalizes.
+    Returns the indices of the values of the sorted array `t` closest to
+    `x` (the first one if equally close).
     """
-    p = np.arange(x.shape[0])
-    y = (x - np.polyval(np.polyfit(p, x, 2), p))
-    l = np.linalg.norm(y, 2)
-    if l == 0:
-        return y
-    else:
-        return y / l
+    i = np.clip(np.searchsorted(t, x), 1, t.shape[0] - 1)
+    return np.where(x - t[i - 1] <= t[i] - x, i - 1, i)
+
+
+def normalize_rows(x: np.ndarray) -> np.ndarray:
+    """
+    Subtracts the trend of every row based on a 2nd degree polynomial (all
+    rows are fitted by one least-squares solve) and normalizes the rows.
+    """
+    p = np.arange(x.shape[1])
+    v = np.stack([p ** 2, p, np.ones_like(p)], axis=1).astype(x.dtype)
+    coef = np.linalg.lstsq(v, x.T, rcond=None)[0]
+    y = x - (v @ coef).T
+    l = np.linalg.norm(y, 2, axis=1, keepdims=True)
+    return np.divide(y, l, out=y, where=l != 0)
 
 
 def _to_reasonable_bpm(bpm: float) -> List[float]:
@@ -64,22 +101,21 @@ def _to_reasonable_bpm(bpm: float) -> List[float]:
     return list(np.sort(cands))
 
 
-def analyze_song(src: AudioFile) -> Tuple[float, float]:
+def _spectrogram(inp: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Determines BPM and offset of the given song.
-    Returns a tuple `bpm, offset`.
+    Computes the spectrogram of the low-passed signal.
+    Returns a tuple `t, Sxx`.
     """
-
-    # Use one minute of the original signal
-    inp = src.stream(0, AudioFile.SAMPLE_RATE * 60)[:, 0]
     b, a = scipy.signal.butter(2, 0.01)
     inp = scipy.signal.lfilter(b, a, inp)
     f, t, Sxx = scipy.signal.spectrogram(inp, AudioFile.SAMPLE_RATE)
+    return t, Sxx
 
-    #
-    # Detect BPM
-    #
 
+def detect_bpm(Sxx: np.ndarray) -> float:
+    """
+    Determines the BPM from the spectrogram of a window of `WINDOW` seconds.
+    """
     Sxx_flat = np.sum(Sxx, axis=0)
     corr = scipy.signal.correlate(Sxx_flat, Sxx_flat, mode='full')
     corr = scipy.ndimage.gaussian_filter(corr, 10)
@@ -88,34 +124,141 @@ def analyze_song(src: AudioFile) -> Tuple[float, float]:
     corr -= np.polyval(np.polyfit(x, corr, 3), x)
     f = np.abs(scipy.fft.fft(corr))
     f = f[:f.shape[0] // 2]
-    abx = np.empty(0)
-    aby = np.empty(0)
-    l = f.shape[0]
-    d = 1
-
-    while l >= 2 and d <= 32:
-        abx, aby = add_pw_functions(np.arange(f.shape[0]) / d, f, abx, aby)
-        l /= 2
-        d += 1
-    ind = (abx >= 30) & (abx <= 180)
-    abx = abx[ind]
-    aby = aby[ind]
+
+    # Sum the harmonics of the spectrum (one for every halving of its
+    # length, at most 32)
+    harmonics = min(int(np.log2(f.shape[0])), 32)
+    abx, aby = harmonic_sum(f, harmonics, 30, 180)
     aby -= np.polyval(np.polyfit(abx, aby, 2), abx)
     bpms = abx[np.argmax(aby)]
-    bpm = _to_reasonable_bpm(bpms)[-1]
+    return _to_reasonable_bpm(bpms)[-1]
 
-    #
-    # Detect offset
-    #
 
+def detect_offset(t: np.ndarray, Sxx: np.ndarray, bpm: float) -> int:
+    """
+    Determines the offset of the first beat (in samples) from the
+    spectrogram.
+    """
+    # Accumulate the normalized bass of (at most 2048) bars
     Sxx_bass = Sxx[0, :]
-    bar = np.abs(t - (60 / bpm) * 4).argmin()
-    acc = np.zeros_like(Sxx_bass[0:bar])
-    for i in range(0, 2048):
-        off = np.abs(t - (60 / bpm) * i * 4).argmin()
-        if off + bar >= Sxx_bass.shape[0]:
-            break
-        acc += normalize(Sxx_bass[off:off + bar])
-    offset = int((t[acc.argmax()] % (60 / bpm)) * AudioFile.SAMPLE_RATE)
-
-    return bpm, offset
+    bar = nearest(t, (60 / bpm) * 4)
+    off = nearest(t, (60 / bpm) * np.arange(2048) * 4)
+    off = off[:np.argmax(np.append(off + bar >= Sxx_bass.shape[0], True))]
+    bars = np.lib.stride_tricks.sliding_window_view(Sxx_bass, bar)[off]
+    acc = np.sum(normalize_rows(bars), axis=0)
+    return int((t[acc.argmax()] % (60 / bpm)) * AudioFile.SAMPLE_RATE)
+
+
+def analyze_song(src: AudioFile) -> Tuple[float, float]:
+    """
+    Determines BPM and offset of the given song.
+    Returns a tuple `bpm, offset`.
+    """
+
+    # Use the first window of the original signal (which might still be
+    # decoding)
+    src.wait(AudioFile.SAMPLE_RATE * WINDOW)
+    inp = src.stream(0, AudioFile.SAMPLE_RATE * WINDOW)[:, 0]
+    t, Sxx = _spectrogram(inp)
+    bpm = detect_bpm(Sxx)
+    return bpm, detect_offset(t, Sxx, bpm)
+
+
+def analyze_segment(inp: np.ndarray, bpm: float) -> Tuple[float, int]:
+    """
+    Determines the local BPM and offset (in samples) of a window of the
+    signal. The BPM is doubled or halved to be close to the `bpm` of the
+    song. Returns NaN as BPM if it deviates too much (e.g., in a break).
+    This runs in a worker process.
+    """
+    t, Sxx = _spectrogram(inp)
+    local = detect_bpm(Sxx)
+    while local > bpm * 1.5:
+        local /= 2
+    while local < bpm * 0.75:
+        local *= 2
+    if abs(local / bpm - 1) > MAX_TEMPO_DEVIATION:
+        return np.nan, 0
+    return local, detect_offset(t, Sxx, local)
+
+
+def _segment_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawn the workers since forking a multi-threaded server is
+            # unsafe
+            _pool = ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def compute_tempo_map(signal: np.ndarray, bpm: float, offset: int,
+        parallel: bool = True) -> Optional[np.ndarray]:
+    """
+    Analyzes the whole (mono) signal in overlapping windows, in parallel
+    worker processes if `parallel`, and returns the start times of all bars
+    (in seconds). The first bar starts at `offset` and the song's `bpm` is
+    used where the local tempo can not be determined. Returns `None` if the
+    signal is shorter than one window.
+    """
+    window = WINDOW * AudioFile.SAMPLE_RATE
+    hop = int(window * (1 - SEGMENT_OVERLAP))
+    if signal.shape[0] < window:
+        return None
+    starts = list(range(0, signal.shape[0] - window + 1, hop))
+    if starts[-1] + window < signal.shape[0]:
+        starts.append(signal.shape[0] - window)
+    segments = [signal[s:s + window] for s in starts]
+    if parallel and len(segments) > 1 and os.cpu_count() > 1:
+        results = list(_segment_pool().map(analyze_segment, segments,
+            [bpm] * len(segments)))
+    else:
+        results = [analyze_segment(segment, bpm) for segment in segments]
+
+    # Beat grid of every window (center, first beat and beat duration in
+    # seconds)
+    grids = [(s / AudioFile.SAMPLE_RATE + WINDOW / 2,
+              (s + off) / AudioFile.SAMPLE_RATE, 60 / local) for
+             s, (local, off) in zip(starts, results) if not np.isnan(local)]
+    if not grids:
+        grids = [(0, offset / AudioFile.SAMPLE_RATE, 60 / bpm)]
+    centers = np.asarray([g[0] for g in grids])
+
+    # Advance bar by bar with the tempo of the closest window and lock to
+    # its beat grid (which corrects drift between windows)
+    duration = signal.shape[0] / AudioFile.SAMPLE_RATE
+    bars = [offset / AudioFile.SAMPLE_RATE]
+    while bars[-1] < duration:
+        _, first, beat = grids[np.abs(centers - bars[-1]).argmin()]
+        predicted = bars[-1] + beat * 4
+        snapped = first + np.round((predicted - first) / beat) * beat
+        bars.append(snapped if abs(snapped - predicted) <= beat * SNAP
+                    else predicted)
+    return np.asarray(bars)
+
+
+def detect_key(src: AudioFile) -> str:
+    """
+    Estimates the musical key of the given song by correlating its pitch
+    class profile with the Krumhansl-Kessler key profiles.
+    Returns the key name, e.g. `A` (major) or `Am` (minor).
+    """
+
+    # Use one minute of the original signal (which might still be decoding)
+    src.wait(AudioFile.SAMPLE_RATE * 60)
+    inp = np.mean(src.stream(0, AudioFile.SAMPLE_RATE * 60), axis=1)
+    f, t, Sxx = scipy.signal.spectrogram(inp, AudioFile.SAMPLE_RATE,
+        nperseg=8192)
+
+    # Accumulate the magnitudes of all bins from A0 to C8 by pitch class
+    ind = (f >= 27.5) & (f <= 4186)
+    pitch_class = (np.rint(12 * np.log2(f[ind] / 440)).astype(np.int32) +
+                   9) % 12
+    chroma = np.bincount(pitch_class,
+        weights=np.sqrt(np.sum(Sxx[ind], axis=1)), minlength=12)
+
+    scores = [(np.corrcoef(np.roll(profile, tonic), chroma)[0, 1],
+               KEY_NAMES[tonic] + suffix) for tonic in range(12) for
+              profile, suffix in [(MAJOR_PROFILE, ''), (MINOR_PROFILE, 'm')]]
+    return max(scores)[1]
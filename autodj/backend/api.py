@@ -1,22 +1,31 @@
-import glob
-import json
+import logging
 import mimetypes
 import os
-import time
-from typing import List
+from typing import List, Optional
 
 import eventlet
+from eventlet import tpool
 import socketio
 
+from autodj.backend.analysis import ANALYSIS_VERSION
 from autodj.backend.audio import AudioFile
-from autodj.backend.channel import TransitionDef
-from autodj.backend.fsm import QueueData, MixerStage
+from autodj.backend.cache import load_analysis
+from autodj.backend.fsm import LayerQueueData
+from autodj.backend.library import LibraryIndexer
 from autodj.backend.mixer import Mixer
-from autodj.backend.song import Song, get_artist_and_title
-
-from threading import Thread
+from autodj.backend.song import Song, get_artist_and_title, waveform_bins, \
+    bar_grid, WAVEFORM_BIN, WAVEFORM_FACTOR
+from autodj.backend.transitions import TransitionRegistry
 
 mixer: Mixer = None
+indexer: LibraryIndexer = None
+transitions: TransitionRegistry = None
+
+# Last status pushed to the clients
+last_status: dict = None
+
+# Maximum number of songs returned per search
+SEARCH_LIMIT = 500
 
 sio = socketio.Server()
 
@@ -25,9 +34,23 @@ def start_api(mix):
     """
     Starts the frontend server and API.
     """
-    global mixer
+    global mixer, indexer, transitions, last_status
     mixer = mix
 
+    # Load the transitions and tell the clients whenever they change
+    transitions = TransitionRegistry(mixer.all_effects)
+    transitions.watch()
+    sio.start_background_task(_report_transitions)
+
+    # Push status updates to the clients
+    last_status = mixer.status
+    sio.start_background_task(_broadcast_status)
+
+    # Index the library in the background
+    indexer = LibraryIndexer()
+    indexer.start()
+    sio.start_background_task(_report_library_progress)
+
     static = {}
     for root, dirs, files in os.walk('frontend'):
         for file in files:
@@ -42,68 +65,125 @@ def start_api(mix):
 ################################################################################
 # Transition management
 
-def _invert_transition(trans: TransitionDef) -> TransitionDef:
+def _report_transitions():
     """
-    Converts an "in" transition into an "out" transition and vice versa.
+    Tells the clients whenever the transitions changed. The watcher runs in
+    its own thread, so the version is polled here instead of emitting from
+    there.
     """
-    res = {}
-    for fx, points in trans.items():
-        res[fx] = [[1 - p[0], p[1]] for p in points]
-    return res
+    last = transitions.version
+    while True:
+        if transitions.version != last:
+            last = transitions.version
+            sio.emit('transitions_changed')
+        sio.sleep(0.5)
 
 
 @sio.event
 def transition_list(sid) -> List[dict]:
     """
-    Returns all transitions.
+    Returns all valid transitions (with `id`, `name` and `fx`).
     """
-    res = []
-    for file in glob.glob('data/transitions/*.json'):
-        with open(file) as j:
-            js = json.load(j)
-            js['file'] = file
-            res.append(js)
-    return res
+    return transitions.list()
 
 
 ################################################################################
 # Song management
 
+def _report_library_progress():
+    """
+    Broadcasts the progress of the library indexer whenever it changes
+    (including songs that are added later).
+    """
+    last = None
+    while True:
+        progress = indexer.progress()
+        if progress != last:
+            sio.emit('library_progress', progress)
+            last = progress
+        sio.sleep(0.5)
+
+
 @sio.event
 def song_list(sid) -> List[dict]:
     """
-    Returns a list of all songs including their artist and title.
+    Returns a list of all songs including their artist and title as well as
+    BPM, length and key if they are already indexed.
     """
-    files = []
-    for ext in ['*.wav', '*.mp3', '*.mp4']:
-        files.extend(glob.glob(os.path.join('data/songs', ext)))
-    songs = []
-    for f in files:
-        artist, title = get_artist_and_title(f)
-        songs.append({'file': f, 'artist': artist, 'title': title})
-    return songs
+    return indexer.songs()
 
 
 @sio.event
-def song_info(sid, file: str) -> dict:
+def song_search(sid, query: str = '', sort: str = 'title',
+        descending: bool = False, offset: int = 0, limit: int = 100) -> dict:
     """
-    Returns detailed information about a song.
+    Searches the songs whose artist or title contain words starting with
+    the words of the query. Returns the `total` number of matches and the
+    `songs` of the requested page, sorted by artist, title or BPM, as well
+    as the `version` of the index (see `library_progress`).
     """
-    with mixer.lock:
-        # Try to find song in the channels first
-        song = None
-        for channel in mixer.channels:
-            if channel.song is not None and channel.song.file == file:
-                song = channel.song
+    version = indexer.search.version
+    # Run in a native thread, since the index may have to be rebuilt
+    total, songs = tpool.execute(indexer.search.search, query, sort,
+        descending, offset, min(limit, SEARCH_LIMIT))
+    return {'total': total, 'songs': songs, 'version': version}
+
 
-        # Otherwise load it
-        if song is None:
+def _find_loaded_song(file: str) -> Optional[Song]:
+    """
+    Returns the song if it is already loaded in a channel.
+    """
+    for channel in mixer.channels:
+        song = channel.song
+        if song is not None and song.file == file:
+            return song
+    return None
+
+
+def _get_song_info(file: str) -> dict:
+    """
+    Collects the information about a song, loading it if necessary (heavy).
+    For a song in a channel that is still being analyzed, the waveform is
+    missing and the grid follows from BPM and offset (see `song_analyzed`).
+    """
+    # Try to find song in the channels first
+    song = _find_loaded_song(file)
+
+    # Otherwise use the cached analysis or load it
+    cached = None
+    if song is None:
+        cached = load_analysis(file, ANALYSIS_VERSION)
+        if cached is None:
             song = Song(file)
+            song.analyzed.wait()
+
+    if song is not None:
+        bpm, offset, length = song.bpm, song.offset, song.length
+        key = song.key
+        waveform = song.waveform
+        tempo_map = song.tempo_map
+    else:
+        bpm, offset, length = cached['bpm'], cached['offset'], cached['length']
+        key = cached['key']
+        waveform = cached['waveform']
+        tempo_map = cached['tempo_map']
+
+    artist, title = get_artist_and_title(file)
+    return {'file': file, 'artist': artist, 'title': title, 'bpm': bpm,
+            'offset': offset / AudioFile.SAMPLE_RATE,
+            'length': length / AudioFile.SAMPLE_RATE, 'key': key,
+            'waveform': {'bin_size': WAVEFORM_BIN, 'factor': WAVEFORM_FACTOR,
+                         'bins': waveform_bins(length), 'data': waveform},
+            'grid': bar_grid(bpm, offset, length, tempo_map)}
 
-        return {'file': song.file, 'artist': song.artist, 'title': song.title,
-                'bpm': song.bpm, 'offset': song.offset / AudioFile.SAMPLE_RATE,
-                'length': song.length / AudioFile.SAMPLE_RATE,
-                'wave_diagram': song.wave_diagram}
+
+@sio.event
+def song_info(sid, file: str) -> dict:
+    """
+    Returns detailed information about a song.
+    """
+    # Run in a native thread to keep the server responsive
+    return tpool.execute(_get_song_info, file)
 
 
 ################################################################################
@@ -114,50 +194,132 @@ def mixer_bpm(sid, bpm: str):
     """
     Sets the global BPM.
     """
-    mixer.global_bpm = int(bpm)
+    bpm = int(bpm)
+
+    def set_bpm():
+        mixer.global_bpm = bpm
+
+    mixer.submit(set_bpm)
+
+
+def _status_delta(old: dict, new: dict) -> dict:
+    """
+    Computes the fields of the status that changed. Changed channels are
+    given as a dictionary from the channel index to their changed fields.
+    """
+    delta = {k: v for k, v in new.items() if
+             k != 'channels' and old.get(k) != v}
+    if len(old['channels']) != len(new['channels']):
+        delta['channels'] = new['channels']
+        return delta
+    channels = {}
+    for i, (a, b) in enumerate(zip(old['channels'], new['channels'])):
+        changed = {k: v for k, v in b.items() if a.get(k) != v}
+        if changed:
+            channels[i] = changed
+    if channels:
+        delta['channels'] = channels
+    return delta
+
+
+def _broadcast_status():
+    """
+    Pushes the changes of the mixer status to all clients once per block.
+    """
+    global last_status
+    seq = None
+    while True:
+        if mixer.status_seq != seq:
+            seq = mixer.status_seq
+            status = mixer.status
+            delta = _status_delta(last_status, status)
+            last_status = status
+            if delta:
+                sio.emit('mixer_status', delta, room='mixer')
+        sio.sleep(0.05)
 
 
 @sio.event
-def mixer_status(sid) -> dict:
+def connect(sid, environ):
     """
-    Returns the global state of the mixer.
+    Subscribes the client to the status updates. The client first receives
+    the full status the following updates are based on.
     """
-    channels = []
-    with mixer.lock:
-        for channel in mixer.channels:
-            channels.append({'time': channel.time,
-                             'file': channel.song.file if channel.song is not
-                                                          None else None,
-                             'is_playing': channel.is_playing,
-                             'transition_bars': channel.transition_bars})
+    sio.enter_room(sid, 'mixer')
+    sio.emit('mixer_status', last_status, to=sid)
+
 
-    return {'time': mixer.global_time, 'bpm': mixer.global_bpm,
-            'channels': channels,
-            'actions': {'load': mixer.fsm.load(None, dry=True).name,
-                        'cancel': mixer.fsm.cancel(dry=True).name,
-                        'queue': mixer.fsm.queue(None, dry=True).name},
-            'stage': mixer.fsm.stage.name, 'stamp': time.time(),
-            'master': mixer.fsm.get_master_channel().name}
+@sio.event
+def mixer_metrics(sid) -> dict:
+    """
+    Returns the render metrics of the mixer, i.e. histograms of the duration
+    of every render stage and the number of underflows.
+    """
+    return mixer.metrics.summary()
 
 
 @sio.event
-def mixer_load(sid, file: str):
+def mixer_status(sid) -> dict:
+    """
+    Returns the global state of the mixer.
+    """
+    return mixer.status
+
+
+def _load_song(file: str, deck: Optional[int] = None):
     """
-    Loads a song into the suitable channel.
+    Loads a song and then puts it into the suitable main channel (or into
+    the layer `deck`).
+    Emits `song_loading` when it starts, `song_ready` once the song is in
+    a channel and `song_analyzed` once its waveform and tempo map are
+    available (if they were not already).
     """
-    song = None
+    sio.emit('song_loading', {'file': file})
 
     # Check if the song is already loaded in a channel (to reuse it)
-    for channel in mixer.channels:
-        if channel.song is not None and channel.song.file == file:
-            song = channel.song
+    song = _find_loaded_song(file)
 
-    # Otherwise load it from disk (heavy)
+    # Otherwise load it from disk (heavy) in a native thread
     if song is None:
-        song = Song(file)
-
-    with mixer.lock:
+        try:
+            song = tpool.execute(Song, file)
+        except Exception:
+            logging.exception(f'Could not load {file}')
+            sio.emit('song_ready', {'file': file, 'channel': None})
+            return
+
+    def load():
+        if deck is not None:
+            target = mixer.fsm.load_layer(deck, song, dry=True)
+            mixer.fsm.load_layer(deck, song)
+            return target
+        target = mixer.fsm.load(song, dry=True)
         mixer.fsm.load(song)
+        return target
+
+    try:
+        target = tpool.execute(mixer.submit(load).result,
+            Mixer.COMMAND_TIMEOUT)
+    except Exception:
+        logging.exception(f'Could not load {file}')
+        target = None
+    sio.emit('song_ready',
+        {'file': file, 'channel': target.name if target else None})
+    if target is None or song.analyzed.is_set():
+        return
+
+    while not song.analyzed.is_set():
+        sio.sleep(0.5)
+    sio.emit('song_analyzed', {'file': file})
+
+
+@sio.event
+def mixer_load(sid, file: str, deck: Optional[int] = None):
+    """
+    Loads a song into the suitable main channel (or into the layer `deck`)
+    without blocking the server.
+    """
+    sio.start_background_task(_load_song, file, deck)
 
 
 @sio.event
@@ -165,22 +327,52 @@ def mixer_cancel(sid):
     """
     Cancels the current transition.
     """
-    with mixer.lock:
-        mixer.fsm.cancel()
+    mixer.submit(mixer.fsm.cancel)
+
+
+@sio.event
+def mixer_queue(sid, transition_ids: List[str],
+        selections: List[List[int]]):
+    """
+    Queues a transition given the IDs of the transitions and the selected
+    bars of every channel.
+    """
+    try:
+        compiled = [transitions.get(tid) if tid is not None else None for
+                    tid in transition_ids]
+    except KeyError as e:
+        logging.error(f'Unknown transition {e}')
+        return
+
+    def queue():
+        mixer.fsm.queue(mixer.fsm.create_queue_data(compiled, selections))
+
+    mixer.submit(queue)
+
+
+@sio.event
+def mixer_queue_layer(sid, deck: int, transition_id: str,
+        selection: List[int], selection_master: Optional[List[int]] = None):
+    """
+    Queues the transition of a layer given the selected bars of the layer
+    and, to fade it in, of the master channel.
+    """
+    try:
+        compiled = transitions.get(transition_id)
+    except KeyError as e:
+        logging.error(f'Unknown transition {e}')
+        return
+
+    def queue():
+        mixer.fsm.queue_layer(deck,
+            LayerQueueData(compiled, selection, selection_master))
+
+    mixer.submit(queue)
 
 
 @sio.event
-def mixer_queue(sid, a_trans: TransitionDef, b_trans: TransitionDef,
-        a_sel: List[int], b_sel: List[int]):
-    """
-    Queues a transition.
-    """
-    with mixer.lock:
-        dir = mixer.fsm.queue(None, dry=True)
-        if dir == MixerStage.B_TO_A:
-            qd = QueueData(_invert_transition(b_trans), a_trans, b_sel, a_sel)
-        elif dir == MixerStage.A_TO_B:
-            qd = QueueData(_invert_transition(a_trans), b_trans, a_sel, b_sel)
-        else:
-            qd = QueueData(a_trans, b_trans, a_sel, b_sel)
-        mixer.fsm.queue(qd)
+def mixer_cancel_layer(sid, deck: int):
+    """
+    Cancels the queued transition of a layer.
+    """
+    mixer.submit(lambda: mixer.fsm.cancel_layer(deck))
@@ -1,9 +1,12 @@
-import io
+import os
 import subprocess
-import wave
+import threading
+from typing import Optional
 
 import numpy as np
 
+from autodj.backend.cache import pcm_path, touch_pcm, evict_pcm
+
 
 class AudioFile:
     """
@@ -11,46 +14,189 @@ class AudioFile:
     """
     SAMPLE_RATE = 48000
 
-    def __init__(self, file: str):
+    # Number of samples normalized at once when writing the cache
+    CHUNK_SIZE = 2 ** 20
+
+    # Initial capacity (in samples) of the buffer while decoding
+    INITIAL_CAPACITY = SAMPLE_RATE * 60
+
+    def __init__(self, file: str, cache: bool = True):
         """
         Loads an audio file. Supports many file formats (e.g., mp3) as it
         uses ffmpeg to convert the file.
+
+        The decoded signal is cached on disk and memory-mapped, so only the
+        parts that are actually played are loaded into memory. If the file is
+        not cached yet, it is decoded in the background and can already be
+        streamed while decoding (see `wait`). Without `cache`, the decoded
+        signal is only kept in memory (e.g., to analyze a song once).
         """
         self.file = file
 
-        # Convert into standard 16bit 48kHz stereo wave file using ffmpeg
-        # Directly pipe the result into our memory
-        pipe = subprocess.run(
-            ['ffmpeg', '-y', '-i', file, '-fflags', '+bitexact', '-flags',
-             '+bitexact', '-acodec', 'pcm_s16le', '-ar',
-             str(AudioFile.SAMPLE_RATE), '-ac', '2', '-f', 'wav', 'pipe:1'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=2 ** 24,
-            check=True)
+        # The signal is published as a tuple `(signal, length, gain)` that is
+        # swapped atomically, so that readers never see inconsistent values
+        self._view = (np.zeros((0, 2), dtype=np.float32), 0, 1.0)
+        self._error: Optional[Exception] = None
+        self._progress = threading.Condition()
+        self._done = False
+
+        path = pcm_path(file)
+        if os.path.exists(path):
+            touch_pcm(path)
+            self._open(path)
+        else:
+            thread = threading.Thread(target=self._decode,
+                args=(path if cache else None,), daemon=True)
+            thread.start()
+
+    @classmethod
+    def from_signal(cls, signal: np.ndarray, file: str = '<signal>'):
+        """
+        Creates an audio file from a normalized float32 stereo signal (e.g.,
+        for synthetic test signals) without decoding anything.
+        """
+        audio = cls.__new__(cls)
+        audio.file = file
+        audio._progress = threading.Condition()
+        audio._publish((signal, signal.shape[0], 1.0), done=True)
+        return audio
+
+    @property
+    def length(self) -> int:
+        """
+        Number of samples decoded so far.
+        """
+        return self._view[1]
+
+    @property
+    def signal(self) -> np.ndarray:
+        """
+        The complete normalized signal. Blocks until the file is decoded.
+        """
+        self.wait()
+        return self._view[0]
+
+    @property
+    def is_decoded(self) -> bool:
+        return self._done
+
+    def wait(self, length: Optional[int] = None):
+        """
+        Blocks until at least `length` samples (or the whole file if `None`)
+        are decoded. Raises the decoding error if ffmpeg failed.
+        """
+        with self._progress:
+            self._progress.wait_for(lambda: self._done or (
+                    length is not None and self.length >= length))
+        if self._error is not None:
+            raise self._error
+
+    def _publish(self, view: tuple, done: bool = False,
+            error: Optional[Exception] = None):
+        with self._progress:
+            self._view = view
+            self._error = error
+            self._done = done
+            self._progress.notify_all()
+
+    def _open(self, path: str, gain: float = 1.0):
+        """
+        Memory-maps the decoded signal from the cache and streams it with
+        the given gain.
+        """
+        if os.path.getsize(path) > 0:
+            signal = np.memmap(path, dtype=np.float32, mode='r').reshape(
+                (-1, 2))
+        else:
+            signal = np.zeros((0, 2), dtype=np.float32)
+        self._publish((signal, signal.shape[0], gain), done=True)
+
+    def _decode(self, path: Optional[str]):
+        """
+        Decodes the file into interleaved 48kHz stereo float32 samples. The
+        output of ffmpeg is read chunk-wise into a growing buffer which is
+        published after every chunk. Finally, the signal is normalized to
+        the peak of the whole file and written to the cache at `path` (or
+        normalized in memory without `path`).
+
+        The peak is only known at the end, so the stream is not amplified
+        (ffmpeg's output is within [-1, 1] for integer sources). Once the
+        normalized signal replaces the stream, its gain undoes the
+        normalization, so the level never changes during playback. Songs
+        that are loaded again from the cache are normalized.
+        """
+        try:
+            # Convert into raw 32bit float 48kHz stereo samples using ffmpeg
+            # Directly pipe the result into our memory
+            proc = subprocess.Popen(
+                ['ffmpeg', '-y', '-i', self.file, '-fflags', '+bitexact',
+                 '-flags', '+bitexact', '-acodec', 'pcm_f32le', '-ar',
+                 str(AudioFile.SAMPLE_RATE), '-ac', '2', '-f', 'f32le',
+                 'pipe:1'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                bufsize=0)
 
-        # Convert PCM output from pipe into numpy float array
-        with wave.open(io.BytesIO(pipe.stdout), 'rb') as wav:
-            self.signal = np.reshape(
-                np.fromstring(wav.readframes(-1), dtype=np.int16).astype(
-                    np.float32) / 32768, (-1, 2))
+            buffer = np.zeros((AudioFile.INITIAL_CAPACITY, 2),
+                dtype=np.float32)
+            num_bytes = 0
+            length = 0
+            peak = 0.0
+            while True:
+                if num_bytes == buffer.nbytes:
+                    # Grow the buffer (readers keep the old one until they
+                    # receive the new view)
+                    grown = np.zeros((buffer.shape[0] * 2, 2),
+                        dtype=np.float32)
+                    grown[:buffer.shape[0]] = buffer
+                    buffer = grown
+                read = proc.stdout.readinto(
+                    memoryview(buffer).cast('B')[num_bytes:])
+                if not read:
+                    break
+                # Only publish complete stereo frames
+                start = num_bytes // 8
+                num_bytes += read
+                length = num_bytes // 8
+                if length > start:
+                    peak = max(peak,
+                        float(np.max(np.abs(buffer[start:length]))))
+                self._publish((buffer, length, 1.0))
 
-        self.length = self.signal.shape[0]
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode,
+                    'ffmpeg')
+            gain = 1 / peak if peak > 0 else 1.0
+            if path is None:
+                for i in range(0, length, AudioFile.CHUNK_SIZE):
+                    buffer[i:min(i + AudioFile.CHUNK_SIZE, length)] *= gain
+                self._publish((buffer, length, 1 / gain), done=True)
+                return
 
-        # Normalize signal
-        max_sig = np.max(np.abs(self.signal))
-        if max_sig > 0:
-            self.signal /= max_sig
+            # Write the normalized signal to the cache
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                for i in range(0, length, AudioFile.CHUNK_SIZE):
+                    (buffer[i:min(i + AudioFile.CHUNK_SIZE, length)] *
+                     gain).tofile(f)
+            os.replace(tmp, path)
+            evict_pcm(path)
+            self._open(path, 1 / gain)
+        except Exception as e:
+            self._publish(self._view, done=True, error=e)
 
     def stream(self, pos: int, length: int) -> np.ndarray:
         """
         Streams the signal at `pos` of with length `length`.
-        Pads with zeros outside of bounds.
+        Pads with zeros outside of bounds (or where not decoded yet).
         """
+        signal, signal_length, gain = self._view
         out = np.zeros((length, 2), dtype=np.float32)
-        if length <= 0 or pos + length <= 0 or pos >= self.length:
+        if length <= 0 or pos + length <= 0 or pos >= signal_length:
             return out
-        from_inp = min(max(pos, 0), self.length)
-        to_inp = min(pos + length, self.length)
+        from_inp = min(max(pos, 0), signal_length)
+        to_inp = min(pos + length, signal_length)
         from_out = min(max(-pos, 0), length)
-        out[from_out:from_out + (to_inp - from_inp)] = self.signal[
-                                                       from_inp:to_inp]
+        out[from_out:from_out + (to_inp - from_inp)] = signal[from_inp:to_inp]
+        if gain != 1.0:
+            out *= gain
         return out
@@ -0,0 +1,142 @@
+# cache: Persistent on-disk caches for decoded audio and song analysis.
+
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+CACHE_DIR = 'data/cache'
+
+# Number of bytes hashed at the start and the end of a file
+FINGERPRINT_SIZE = 2 ** 20
+
+# Maximum size of the decoded signals in the cache (in bytes), beyond which
+# the least recently used ones are removed
+PCM_CACHE_SIZE = 16 * 2 ** 30
+
+
+def fingerprint(file: str) -> str:
+    """
+    Computes a content hash of a file. Only the size and the first and last
+    megabyte are hashed, which identifies a song reliably while staying cheap
+    for large libraries.
+    """
+    size = os.path.getsize(file)
+    h = hashlib.sha1(str(size).encode())
+    with open(file, 'rb') as f:
+        h.update(f.read(FINGERPRINT_SIZE))
+        if size > FINGERPRINT_SIZE:
+            f.seek(max(size - FINGERPRINT_SIZE, FINGERPRINT_SIZE))
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def write_atomic(path: str, data: bytes):
+    """
+    Writes a file such that concurrent readers never see partial content.
+    """
+    tmp = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _analysis_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, 'analysis', key)
+
+
+def pcm_path(file: str) -> str:
+    """
+    Returns the path of the decoded signal of a file. The modification time
+    is part of the name so that changed files are decoded again.
+    """
+    mtime = os.stat(file).st_mtime_ns
+    return os.path.join(CACHE_DIR, 'pcm', f'{fingerprint(file)}-{mtime}.f32')
+
+
+def touch_pcm(path: str):
+    """
+    Marks a decoded signal in the cache as used.
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def evict_pcm(keep: str, limit: int = PCM_CACHE_SIZE):
+    """
+    Removes the decoded signals of previous versions of the file at `keep`
+    as well as the least recently used signals until the cache fits into
+    `limit` bytes. `keep` itself is never removed. Signals that are still
+    memory-mapped stay readable until they are closed.
+    """
+    directory = os.path.dirname(keep)
+    prefix = os.path.basename(keep).split('-')[0] + '-'
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not name.endswith('.f32') or path == keep:
+            continue
+        try:
+            if name.startswith(prefix):
+                # Superseded since the file changed
+                os.remove(path)
+            else:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        except OSError:
+            pass
+
+    try:
+        total = os.path.getsize(keep) + sum(e[1] for e in entries)
+    except OSError:
+        return
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def load_analysis(file: str, version: int) -> Optional[dict]:
+    """
+    Returns the cached analysis of a song (e.g., `bpm`, `offset`, `length`
+    and `waveform`) or `None` if there is no valid entry. Entries are
+    invalidated if the file's modification time or size changed or if they
+    were computed by another `version` of the analysis.
+    """
+    try:
+        stat = os.stat(file)
+        path = _analysis_path(fingerprint(file))
+        with open(path + '.json') as j:
+            entry = json.load(j)
+        if entry['version'] != version or entry['mtime'] != \
+                stat.st_mtime_ns or entry['size'] != stat.st_size:
+            return None
+        with open(path + '.peaks', 'rb') as f:
+            entry['waveform'] = f.read()
+        return entry
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_analysis(file: str, version: int, analysis: dict,
+        waveform: bytes):
+    """
+    Stores the analysis of a song in the cache. `analysis` must be
+    serializable to JSON.
+    """
+    stat = os.stat(file)
+    path = _analysis_path(fingerprint(file))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write the waveform first so a valid index never points to a missing
+    # file
+    write_atomic(path + '.peaks', waveform)
+    write_atomic(path + '.json', json.dumps(
+        dict(analysis, version=version, mtime=stat.st_mtime_ns,
+            size=stat.st_size)).encode())
@@ -1,38 +1,142 @@
 import logging
 from enum import Enum
-from typing import Dict, List, Callable, Tuple, Optional
-import scipy.interpolate
+from typing import Dict, List, Tuple, Optional, Type, Any
 
 import numpy as np
-import scipy
+from attr import dataclass
 
 from autodj.backend.song import Song
+from autodj.backend.stretch import Stretcher, WsolaStretcher, \
+    LookaheadRenderer
 
 TransitionDef = Dict[str, List[Tuple[float, float]]]
-TransitionFunc = Dict[str, Callable[[np.ndarray], np.ndarray]]
 
 
-def create_transition_func(mixer, trans: TransitionDef, start: float,
-        end: float, inp: bool) -> TransitionFunc:
+class Automation:
     """
-    Computes the transition function for the given transition.
+    Piecewise linear automation of an effect parameter over time (in
+    seconds) given by breakpoints. Before the first and after the last
+    breakpoint the parameter is `left` and `right`, respectively.
     """
-    res = {}
-    length = end - start
 
+    def __init__(self, x: np.ndarray, y: np.ndarray, left: float,
+            right: float):
+        order = np.argsort(x, kind='stable')
+        self.x = np.asarray(x, dtype=np.float64)[order]
+        self.y = np.asarray(y, dtype=np.float64)[order]
+        self.left = left
+        self.right = right
+
+    def __call__(self, t: np.ndarray) -> np.ndarray:
+        return np.interp(t, self.x, self.y, left=self.left, right=self.right)
+
+    def evaluate(self, t: np.ndarray, out: np.ndarray):
+        """
+        Evaluates the automation at the increasing times `t` into `out`
+        segment by segment (without allocating buffers).
+        """
+        x, y = self.x, self.y
+        bounds = np.searchsorted(t, x)
+        out[:bounds[0]] = self.left
+        for k in range(len(x) - 1):
+            a, b = bounds[k], bounds[k + 1]
+            if a < b:
+                np.subtract(t[a:b], x[k], out=out[a:b])
+                out[a:b] *= (y[k + 1] - y[k]) / (x[k + 1] - x[k])
+                out[a:b] += y[k]
+        # Like np.interp, the last breakpoint itself has its value
+        end = np.searchsorted(t, x[-1], side='right')
+        out[bounds[-1]:end] = y[-1]
+        out[end:] = self.right
+
+    def constant_over(self, start: float, end: float) -> Optional[float]:
+        """
+        Returns the value if the automation is constant between `start` and
+        `end` (otherwise `None`). Only the bounds and the breakpoints in
+        between are evaluated.
+        """
+        inner = (self.x > start) & (self.x < end)
+        if not np.any(inner):
+            # Both bounds are within the same segment
+            values = self(np.asarray([start, end]))
+        else:
+            values = np.concatenate((self([start, end]), self.y[inner]))
+        if np.all(values == values[0]):
+            return float(values[0])
+        return None
+
+
+TransitionFunc = Dict[str, Automation]
+
+# Breakpoints (normalized time and value) and the values before and after
+# them per effect
+CompiledFx = Dict[str, Tuple[np.ndarray, np.ndarray, float, float]]
+
+
+@dataclass
+class CompiledTransition:
+    """
+    A validated transition with the breakpoints of every effect prepared for
+    fading in and out, so only the timing remains to be applied when it is
+    queued.
+    """
+    fade_in: CompiledFx
+    fade_out: CompiledFx
+
+    def automate(self, start: float, end: float,
+            inp: bool) -> TransitionFunc:
+        """
+        Returns the automations of the transition from `start` to `end` (in
+        seconds of the song), fading in if `inp` and out otherwise.
+        """
+        length = end - start
+        return dict((fx, Automation(start + x * length, y, left, right)) for
+                    fx, (x, y, left, right) in
+                    (self.fade_in if inp else self.fade_out).items())
+
+
+def compile_transition(trans: TransitionDef,
+        effects: Dict[str, Any]) -> CompiledTransition:
+    """
+    Validates the given "in" transition and compiles it for both directions.
+    Raises a `ValueError` for unknown effects and breakpoints that are not
+    sorted or outside of [0, 1].
+    """
+    if not isinstance(trans, dict):
+        raise ValueError('The effects must be an object')
+    fade_in, fade_out = {}, {}
     for fx, data in trans.items():
-        d = np.asarray(data).T
+        if fx not in effects:
+            raise ValueError(f'Unknown effect {fx}')
+        try:
+            d = np.asarray(data, dtype=np.float64)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid breakpoints of {fx}')
+        if d.ndim != 2 or d.shape[0] == 0 or d.shape[1] != 2:
+            raise ValueError(f'The breakpoints of {fx} must be pairs')
+        if not np.all((d >= 0) & (d <= 1)):
+            raise ValueError(f'The breakpoints of {fx} must be within [0, 1]')
+        if np.any(np.diff(d[:, 0]) < 0):
+            raise ValueError(f'The breakpoints of {fx} must be sorted')
+
         # Set out of bounds value to default value (i.e. no effect)
-        left_bound = mixer.all_effects[fx].DefaultValue
-        right_bound = left_bound
+        default = effects[fx].DefaultValue
         # Volume is special because we want to fade in/out completely
-        if fx == 'vol':
-            left_bound = 0.0 if inp else 1.0
-            right_bound = 1.0 if inp else 0.0
+        fade_in[fx] = (d[:, 0], d[:, 1], 0.0, 1.0) if fx == 'vol' else (
+            d[:, 0], d[:, 1], default, default)
+        # Fading out runs backwards in time
+        fade_out[fx] = (1 - d[::-1, 0], d[::-1, 1], 1.0, 0.0) if \
+            fx == 'vol' else (1 - d[::-1, 0], d[::-1, 1], default, default)
+    return CompiledTransition(fade_in, fade_out)
+
 
-        res[fx] = scipy.interpolate.interp1d(start + d[0] * length, d[1],
-            fill_value=(left_bound, right_bound), bounds_error=False)
-    return res
+def create_transition_func(mixer, trans: TransitionDef, start: float,
+        end: float, inp: bool) -> TransitionFunc:
+    """
+    Compiles the given transition into an automation of every effect.
+    """
+    return compile_transition(trans, mixer.all_effects).automate(start, end,
+        inp)
 
 
 class TransitionStage(Enum):
@@ -54,18 +158,46 @@ class Channel:
     Represents a channel in the mixer.
     """
 
-    def __init__(self):
+    def __init__(self, stretcher: Type[Stretcher] = WsolaStretcher,
+            lookahead: bool = True):
+        """
+        Initializes a channel that uses the given type of time stretcher.
+        If not `lookahead`, every block is stretched inline.
+        """
+        # Renders the stretched song ahead of the playhead
+        self.renderer = LookaheadRenderer(stretcher, threaded=lookahead)
+        # Preallocated buffers for rendering (see `prepare`)
+        self.buffers: Tuple[np.ndarray, np.ndarray] = None
+        self.ramp: np.ndarray = None
+        self.t: np.ndarray = None
+        self.clear()
+
+    def prepare(self, block_size: int):
+        """
+        Allocates the buffers to render blocks of the given size (unless
+        they already have that size).
+        """
+        if self.t is not None and self.t.shape[0] == block_size:
+            return
+        self.buffers = (np.zeros((block_size, 2), dtype=np.float32),
+                        np.zeros((block_size, 2), dtype=np.float32))
+        # Relative position of every sample in the block
+        self.ramp = np.arange(block_size) / block_size
+        # Time of every sample in the block
+        self.t = np.zeros(block_size)
+        # Parameter of the current effect for every sample in the block
+        self.param = np.zeros(block_size, dtype=np.float32)
+
+    def clear(self):
         self.time: float = 0.0
         self.song: Optional[Song] = None
-        self.transient: np.ndarray = None
+        self.renderer.stop()
         self.transition: TransitionFunc = {}
         self.transition_bars: List[int] = None
-        self.last: np.ndarray = None
+        # State of the effects (e.g., reverb tails) between blocks
+        self.fx_state: Dict[str, Any] = {}
         self.is_playing: bool = False
 
-    def clear(self):
-        self.__init__()
-
     def load(self, song: Song):
         self.clear()
         self.song = song
@@ -75,8 +207,18 @@ class Channel:
         self.transition = {}
         self.transition_bars = None
 
+    def stop(self):
+        """
+        Stops playing, the song stays loaded.
+        """
+        self.renderer.stop()
+        self.clear_transition()
+        self.fx_state = {}
+        self.is_playing = False
+
     def play(self, time: float):
         self.time = time
+        self.fx_state = {}
         self.is_playing = True
 
     def stage(self) -> TransitionStage:
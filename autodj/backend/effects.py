@@ -1,10 +1,12 @@
 import ctypes
+import logging
 import math
 import os
 from abc import ABC
-from typing import Callable, Tuple
+from typing import Callable, Tuple, Dict, Any, List
 
 import numpy as np
+import scipy.fft
 import scipy.interpolate
 import scipy.signal
 import scipy.signal.signaltools
@@ -13,24 +15,51 @@ from autodj.backend.audio import AudioFile
 
 
 class Effect(ABC):
+    """
+    Base class of the effects. An effect processes one block of stereo
+    samples `inp` into `out` (both preallocated), where `param` contains the
+    parameter of every sample.
+    """
     ID = None
     DefaultValue = 0.0
 
+    def create_state(self) -> Any:
+        """
+        Creates the state of the effect that is kept per channel between
+        blocks (e.g., a reverb tail). Stateless effects return `None`.
+        """
+        return None
+
     def apply(self, inp: np.ndarray, out: np.ndarray, param: np.ndarray,
-            bpm: float):
+            bpm: float, state: Any = None):
         raise NotImplementedError('Abstract base class')
 
 
+class FilterState:
+    """
+    State of an IIR filter for one channel.
+    """
+
+    def __init__(self, num_sections: int):
+        # Delay elements of every section (as expected by `sosfilt`)
+        self.zi = np.zeros((num_sections, 2, 2), dtype=np.float32)
+
+
 class IIR(Effect):
     """
     Implements an Infinite Impulse Response filter with a dynamic cutoff.
     This effect is partially written in C (see `iir.c`).
 
-    The dynamic cutoff is implemented by precomputing a numerator/denumerator
-    coefficients table for a fixed number of cutoffs and selecting them while
-    traversing the samples.
+    The dynamic cutoff is implemented by precomputing a table of biquad
+    coefficients for a fixed number of cutoffs and interpolating between them
+    while traversing the samples. The filter state is kept between blocks.
+    If the C library is not built, SciPy's `sosfilt` is used on short
+    sub-blocks instead.
     """
 
+    # Number of samples filtered with the same coefficients by the fallback
+    SUB_BLOCK_SIZE = 64
+
     def __init__(self,
             designer: Callable[[float], Tuple[np.ndarray, np.ndarray]],
             resolution: int = 256):
@@ -46,27 +75,81 @@ class IIR(Effect):
         super().__init__()
         self.resolution = resolution
         # Load the C implementation of the IIR.
-        self.lib = ctypes.CDLL(
-            os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                'lib/libiir.so'))
-        # Precompute the coefficient table on 0.0 to 1.0.
-        self.coef_table = np.asarray(
-            [designer(p) for p in np.linspace(0.0, 1.0, resolution)]).astype(
-            np.float32)
+        try:
+            self.lib = ctypes.CDLL(
+                os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    'lib/libiir.so'))
+        except OSError:
+            logging.warning('libiir.so is not built, falling back to SciPy')
+            self.lib = None
+        # Precompute the coefficient table on 0.0 to 1.0 as second-order
+        # sections (b0, b1, b2, a1, a2) normalized by a0.
+        self.coef_table = np.ascontiguousarray(np.asarray(
+            [IIR._to_sections(*designer(p)) for p in
+             np.linspace(0.0, 1.0, resolution)]), dtype=np.float32)
+
+    @staticmethod
+    def _to_sections(b: np.ndarray, a: np.ndarray) -> np.ndarray:
+        b = np.asarray(b, dtype=np.float64)
+        a = np.asarray(a, dtype=np.float64)
+        if a[0] == 0:
+            # Special cases of the designers (no-pass and all-pass)
+            a = np.asarray([1.0, 0.0, 0.0])
+        if len(b) > 3 or len(a) > 3:
+            sos = scipy.signal.tf2sos(b, a)
+        else:
+            sos = np.concatenate((np.pad(b, (0, 3 - len(b))),
+                                  np.pad(a, (0, 3 - len(a)))))[None]
+        sos = sos / sos[:, 3:4]
+        return np.delete(sos, 3, axis=1)
+
+    def create_state(self) -> FilterState:
+        return FilterState(self.coef_table.shape[1])
+
+    def filter(self, inp: np.ndarray, out: np.ndarray, param: np.ndarray,
+            state: FilterState):
+        """
+        Filters `inp` into `out` and updates the state.
+        """
+        param = np.ascontiguousarray(param, dtype=np.float32)
+        if self.lib is not None:
+            # Call the external C function.
+            inp = np.ascontiguousarray(inp, dtype=np.float32)
+            self.lib.biquad(
+                self.coef_table.ctypes.data_as(
+                    ctypes.POINTER(ctypes.c_float)),
+                ctypes.c_int32(self.resolution),
+                ctypes.c_int32(self.coef_table.shape[1]),
+                param.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                state.zi.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                inp.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                out.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                ctypes.c_int32(inp.shape[0]), ctypes.c_int32(inp.shape[1]))
+            return
+
+        # Filter sub-blocks with the coefficients at their center (merging
+        # consecutive sub-blocks with the same coefficients)
+        size = IIR.SUB_BLOCK_SIZE
+        starts = np.arange(0, inp.shape[0], size)
+        centers = np.minimum(starts + size // 2, inp.shape[0] - 1)
+        positions = np.clip(param[centers], 0, 1) * (self.resolution - 1)
+        bounds = np.concatenate(([0], np.nonzero(np.diff(positions))[0] + 1,
+                                 [len(starts)]))
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            pos = positions[first]
+            k = min(int(pos), self.resolution - 2)
+            coef = self.coef_table[k] + (pos - k) * (
+                    self.coef_table[k + 1] - self.coef_table[k])
+            sos = np.insert(coef, 3, 1.0, axis=1)
+            i, j = starts[first], starts[last - 1] + size
+            out[i:j], state.zi[:] = scipy.signal.sosfilt(sos, inp[i:j],
+                axis=0, zi=state.zi)
 
     def apply(self, inp: np.ndarray, out: np.ndarray, param: np.ndarray,
-            bpm: float):
-        # Turn the continuous cutoff values into discrete indices for the
-        # coefficient table.
-        indices = np.rint(param * (self.resolution - 1)).astype(np.int32)
-        # Call the external C function.
-        self.lib.iir(
-            self.coef_table.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
-            ctypes.c_int32(self.coef_table.shape[2]),
-            indices.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
-            inp.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
-            out.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
-            ctypes.c_int32(inp.shape[0]))
+            bpm: float, state: Any = None):
+        if state is None:
+            state = self.create_state()
+        self.filter(inp, out, param, state)
 
 
 class LowPass(IIR):
@@ -93,8 +176,20 @@ class LowPass(IIR):
         super().__init__(designer)
 
     def apply(self, inp: np.ndarray, out: np.ndarray, param: np.ndarray,
-            bpm: float):
-        super().apply(inp, out, param, bpm)
+            bpm: float, state: Any = None):
+        super().apply(inp, out, param, bpm, state)
+
+
+class NoiseState(FilterState):
+    """
+    State of the noise effect for one channel.
+    """
+
+    def __init__(self, num_sections: int):
+        super().__init__(num_sections)
+        # Position in the noise loop
+        self.pos = 0
+        self.noise = None
 
 
 class Noise(IIR):
@@ -105,7 +200,9 @@ class Noise(IIR):
     DefaultValue = 0.0
 
     def __init__(self):
-        self.noise = AudioFile('data/fx/noise.mp3').signal
+        # Loop the noise (mixed with its reverse to hide the loop)
+        noise = AudioFile('data/fx/noise.mp3').signal
+        self.noise = (noise + np.flip(noise, axis=0)) / 2
         cut_freq = np.asarray([1, 500, 1000, 2500, 5000]) / 24000
         cut_interp = scipy.interpolate.interp1d(
             np.linspace(0.0, 1.0, len(cut_freq)), cut_freq)
@@ -114,17 +211,30 @@ class Noise(IIR):
                 cut_interp(cut))))
         super().__init__(designer)
 
+    def create_state(self) -> NoiseState:
+        return NoiseState(self.coef_table.shape[1])
+
     def apply(self, inp: np.ndarray, out: np.ndarray, param: np.ndarray,
-            bpm: float):
-        num_repeats = inp.shape[0] / self.noise.shape[0]
-        noise_rep = np.tile(self.noise, (int(math.ceil(num_repeats)), 1))[
-                    :out.shape[0]]
-        noise_rep += np.flip(noise_rep, axis=0)
-        noise_rep /= 2
-        tmp = np.zeros_like(noise_rep)
-        super().apply(noise_rep, tmp, param, bpm)
-        out[:, 0] = tmp[:, 0] * param + inp[:, 0] * (1 - param)
-        out[:, 1] = tmp[:, 1] * param + inp[:, 1] * (1 - param)
+            bpm: float, state: Any = None):
+        if state is None:
+            state = self.create_state()
+        if state.noise is None or state.noise.shape != inp.shape:
+            state.noise = np.empty_like(inp)
+
+        # Continue the noise loop
+        noise = state.noise
+        i = 0
+        while i < noise.shape[0]:
+            length = min(noise.shape[0] - i, self.noise.shape[0] - state.pos)
+            noise[i:i + length] = self.noise[state.pos:state.pos + length]
+            state.pos = (state.pos + length) % self.noise.shape[0]
+            i += length
+
+        # Filter the noise and mix it into the input
+        super().apply(noise, noise, param, bpm, state)
+        np.subtract(noise, inp, out=out)
+        out *= param[:, None]
+        out += inp
 
 
 class HighPass(IIR):
@@ -151,28 +261,105 @@ class HighPass(IIR):
         super().__init__(designer)
 
     def apply(self, inp: np.ndarray, out: np.ndarray, param: np.ndarray,
-            bpm: float):
-        super().apply(inp, out, param, bpm)
+            bpm: float, state: Any = None):
+        super().apply(inp, out, param, bpm, state)
+
+
+class ConvolutionState:
+    """
+    State of a partitioned convolution for one channel.
+    """
+
+    def __init__(self):
+        self.block_size = None
+
+    def reset(self, block_size: int, num_partitions: int):
+        self.block_size = block_size
+        # Frequency-domain delay line (ring of the recent input spectra)
+        self.fdl = np.zeros((num_partitions, block_size + 1, 2),
+            dtype=np.complex64)
+        self.pos = 0
+        # Input of the previous and the current block
+        self.inp = np.zeros((block_size * 2, 2), dtype=np.float32)
+        # Spectrum of the output and a partial sum of it
+        self.spectrum = np.zeros((block_size + 1, 2), dtype=np.complex64)
+        self.partial = np.zeros((block_size + 1, 2), dtype=np.complex64)
+
+    def clear(self):
+        self.block_size = None
 
 
 class Reverb(Effect):
     """
     Implements a convolution reverb.
+
+    The impulse response is split into partitions of the block size whose
+    spectra are precomputed. Every block is transformed once, and the
+    spectra of the recent blocks are multiplied with the partitions
+    (uniformly partitioned overlap-save). Thus, the tail of the reverb
+    continues over the following blocks.
     """
     ID = 'rev'
     DefaultValue = 0.0
 
     def __init__(self):
         super().__init__()
-        self.ir = AudioFile('data/fx/reverb.wav').signal[0:48000]
+        self.ir = np.array(AudioFile('data/fx/reverb.wav').signal[0:48000])
         self.ir /= np.sum(self.ir)
+        # Spectra of the partitions per block size
+        self.partitions: Dict[int, np.ndarray] = {}
+
+    def _get_partitions(self, block_size: int) -> np.ndarray:
+        if block_size not in self.partitions:
+            num = int(math.ceil(self.ir.shape[0] / block_size))
+            ir = np.zeros((num * block_size, 2), dtype=np.float32)
+            ir[:self.ir.shape[0]] = self.ir
+            self.partitions[block_size] = np.stack(
+                [scipy.fft.rfft(p, n=block_size * 2, axis=0) for p in
+                 np.split(ir, num)]).astype(np.complex64)
+        return self.partitions[block_size]
+
+    def create_state(self) -> ConvolutionState:
+        return ConvolutionState()
 
     def apply(self, inp: np.ndarray, out: np.ndarray, param: np.ndarray,
-            bpm: float):
-        conv = scipy.signal.fftconvolve(inp, self.ir, mode='full', axes=[0])
-        off = self.ir.shape[0] - 1
-        par = np.repeat([param], 2, axis=0).T
-        out[:] = conv[:-off] * par + (1 - par) * inp
+            bpm: float, state: Any = None):
+        if state is None:
+            state = self.create_state()
+        n = inp.shape[0]
+
+        if not np.any(param):
+            # The reverb is off, so the tail is dropped
+            state.clear()
+            out[:] = inp
+            return
+
+        partitions = self._get_partitions(n)
+        if state.block_size != n:
+            state.reset(n, partitions.shape[0])
+
+        # Add the spectrum of the last two blocks to the delay line and
+        # multiply the delay line with the partitions
+        state.inp[:n] = state.inp[n:]
+        state.inp[n:] = inp
+        state.pos = (state.pos + 1) % partitions.shape[0]
+        state.fdl[state.pos] = scipy.fft.rfft(state.inp, axis=0)
+        # The spectrum at `pos - k` is multiplied with partition `k`, i.e.,
+        # the ring is split into two slices matching reversed partitions
+        # (views, so the delay line is not copied)
+        pos = state.pos
+        np.einsum('kfc,kfc->fc', state.fdl[:pos + 1], partitions[pos::-1],
+            out=state.spectrum)
+        if pos + 1 < partitions.shape[0]:
+            np.einsum('kfc,kfc->fc', state.fdl[pos + 1:],
+                partitions[:pos:-1], out=state.partial)
+            state.spectrum += state.partial
+        conv = scipy.fft.irfft(state.spectrum, n=n * 2, axis=0)
+
+        # Mix the reverb into the input
+        np.subtract(conv[n:], inp, out=out)
+        out *= param[:, None]
+        out += inp
 
 
 class Volume(Effect):
@@ -186,35 +373,99 @@ class Volume(Effect):
         super().__init__()
 
     def apply(self, inp: np.ndarray, out: np.ndarray, param: np.ndarray,
-            bpm: float):
+            bpm: float, state: Any = None):
         # Use square-rooted parameter to keep equal power in transitions
-        par = np.repeat([np.sqrt(param)], 2, axis=0).T
-        out[:] = inp * par
+        np.multiply(inp, np.sqrt(param)[:, None], out=out)
+
+
+class DelayState(FilterState):
+    """
+    State of the delay effect for one channel.
+    """
+
+    def __init__(self, num_sections: int, capacity: int):
+        super().__init__(num_sections)
+        # Delay line of both stereo channels
+        self.ring = np.zeros((capacity, 2), dtype=np.float32)
+        # Write position in the delay line
+        self.pos = 0
+        # Highpassed signal and echoes of the current block
+        self.hp = None
+        self.wet = None
+        self.cutoff = None
+
+
+def _ring_slices(start: int, length: int, capacity: int) -> \
+        List[Tuple[slice, slice]]:
+    """
+    Splits `length` samples of a ring buffer starting at `start` into (at
+    most two) pairs of slices of the ring and of the samples.
+    """
+    start %= capacity
+    first = min(length, capacity - start)
+    return [(slice(start, start + first), slice(0, first)),
+            (slice(0, length - first), slice(first, length))]
 
 
 class Delay(HighPass):
     """
-    Implements a simple delay effect (3/16).
+    Implements a tempo-synced feedback delay. The echoes are kept in a delay
+    line per channel, so they continue over the following blocks.
     """
     ID = 'dly'
     DefaultValue = 0.0
 
+    # Delay of the left and the right channel (in beats)
+    DIVISIONS = [0.5, 1.0]
+    # Gain of every further echo
+    FEEDBACK = 0.4
+    # Lowest BPM for which the delay line is long enough
+    MIN_BPM = 40
+
     def __init__(self):
         super().__init__()
 
+    def create_state(self) -> DelayState:
+        capacity = int(max(Delay.DIVISIONS) * 60 / Delay.MIN_BPM *
+                       AudioFile.SAMPLE_RATE) + 1
+        return DelayState(self.coef_table.shape[1], capacity)
+
     def apply(self, inp: np.ndarray, out: np.ndarray, param: np.ndarray,
-            bpm: float):
-        tmp = np.zeros_like(out)
+            bpm: float, state: Any = None):
+        if state is None:
+            state = self.create_state()
+        n = inp.shape[0]
+        if state.hp is None or state.hp.shape[0] != n:
+            state.hp = np.empty_like(inp)
+            state.wet = np.empty_like(inp)
+            state.cutoff = np.full(n, 0.5, dtype=np.float32)
+        hp, wet, ring = state.hp, state.wet, state.ring
+        capacity = ring.shape[0]
 
         # Highpass the signal first to reduce bass delay
-        super().apply(inp, tmp, np.ones(param.shape[0], dtype=np.float32) * 0.5,
-            bpm)
-        
-        par = np.repeat([param], 2, axis=0).T
-
-        off = int(60 / bpm * AudioFile.SAMPLE_RATE / 2)
-        tmp[off:, 0] += tmp[:-off, 0]
-        tmp[off * 2:, 1] += tmp[:-off * 2, 1]
-
-        out[:] = inp + tmp * par
-
+        super().apply(inp, hp, state.cutoff, bpm, state)
+
+        delays = [min(max(int(div * 60 / bpm * AudioFile.SAMPLE_RATE), 1),
+            capacity - 1) for div in Delay.DIVISIONS]
+
+        # Process chunks that are not longer than the delays, so the echoes
+        # only depend on samples already in the delay line
+        i = 0
+        while i < n:
+            length = min([n - i] + delays)
+            chunk = slice(i, i + length)
+            for c, d in enumerate(delays):
+                for ring_slice, chunk_slice in _ring_slices(
+                        state.pos + i - d, length, capacity):
+                    wet[chunk][chunk_slice, c] = ring[ring_slice, c]
+            for ring_slice, chunk_slice in _ring_slices(state.pos + i,
+                    length, capacity):
+                np.multiply(wet[chunk][chunk_slice], Delay.FEEDBACK,
+                    out=ring[ring_slice])
+                ring[ring_slice] += hp[chunk][chunk_slice]
+            i += length
+        state.pos = (state.pos + n) % capacity
+
+        np.add(hp, wet, out=out)
+        out *= param[:, None]
+        out += inp
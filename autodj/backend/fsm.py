@@ -1,10 +1,10 @@
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Set
 
 from attr import dataclass
 
-from autodj.backend.channel import TransitionStage, create_transition_func, \
-    Channel, TransitionDef
+from autodj.backend.channel import TransitionStage, Channel, \
+    CompiledTransition
 from autodj.backend.song import Song
 
 
@@ -12,64 +12,123 @@ class TargetChannel(Enum):
     INVALID = 0
     A = 1
     B = 2
+    C = 3
+    D = 4
+    E = 5
+    F = 6
+    G = 7
+    H = 8
 
 
-class MixerStage(Enum):
-    INVALID = 0,
-    # No song or just one song (in channel A) is active
-    INIT_A = 1,
-    # If we queue, then for a transition from A to B
-    A_TO_B = 2,
-    # If we queue, then for a transition from B to A
-    B_TO_A = 3
+# Maximum number of channels of the mixer
+MAX_CHANNELS = len(TargetChannel) - 1
+
+# Number of main channels (A and B) that alternate with transitions, the
+# further channels are layers
+MAIN_CHANNELS = 2
+
+
+@dataclass(frozen=True)
+class MixerStage:
+    """
+    Represents the stage of the mixer, i.e., the direction of the next
+    transition from channel `src` to channel `dst` (indices). Without `src`,
+    only `dst` is loaded and fades in first. The names follow the channels
+    (e.g., `INIT_A` or `A_TO_B`).
+    """
+    src: Optional[int]
+    dst: Optional[int]
+
+    @property
+    def name(self) -> str:
+        if self.dst is None:
+            return 'INVALID'
+        if self.src is None:
+            return f'INIT_{TargetChannel(self.dst + 1).name}'
+        return f'{TargetChannel(self.src + 1).name}_TO_' \
+               f'{TargetChannel(self.dst + 1).name}'
+
+
+MixerStage.INVALID = MixerStage(None, None)
+# No song or just one song (in channel A) is active
+MixerStage.INIT_A = MixerStage(None, 0)
+
+
+class LayerAction(Enum):
+    INVALID = 0
+    # The layer fades in (in sync with the master channel)
+    FADE_IN = 1
+    # The playing layer fades out
+    FADE_OUT = 2
 
 
 @dataclass
 class QueueData:
-    transition_src: TransitionDef
-    transition_dst: TransitionDef
+    transition_src: CompiledTransition
+    transition_dst: CompiledTransition
     selection_src: List[int]
     selection_dst: List[int]
 
 
+@dataclass
+class LayerQueueData:
+    transition: CompiledTransition
+    selection: List[int]
+    # Bars of the master channel the selection starts with (only to fade in)
+    selection_master: Optional[List[int]]
+
+
 class MixerFSM:
     """
     Implements the Finite State Machine that controls the mixer via three
     operations: load a song, queue a transition and cancel a queued transition.
+
+    The main channels A and B alternate: after a transition from one to the
+    other, songs are loaded into the one that faded out. Further channels
+    (C, D, ...) are layers on top of them (e.g., loops or acapellas) with
+    their own operations: each layer is loaded, faded in in sync with the
+    master channel and faded out independently, so any number of layers
+    can be audible at once. A layer stops once it has faded out and can then
+    be faded in again.
     """
 
     def __init__(self, mixer):
         self.mixer = mixer
         self.stage = MixerStage.INIT_A
+        # Layers whose queued transition fades them out
+        self.fading_out: Set[int] = set()
+
+    def _next(self, index: int) -> int:
+        return (index + 1) % MAIN_CHANNELS
+
+    def _is_layer(self, index: int) -> bool:
+        return MAIN_CHANNELS <= index < len(self.mixer.channels)
 
     def update(self):
-        channel_a = self.mixer.channels[0]
-        stage_a = channel_a.stage()
-        channel_b = self.mixer.channels[1]
+        for index in list(self.fading_out):
+            channel = self.mixer.channels[index]
+            if channel.stage() == TransitionStage.POST:
+                # The layer has faded out, so it can be faded in again
+                channel.stop()
+                self.fading_out.discard(index)
 
-        if self.stage == MixerStage.INIT_A and stage_a == \
-                TransitionStage.POST and channel_b.song is not None:
-            # A has faded in and we can now enable transitions from A to B
-            self.stage = MixerStage.A_TO_B
+        if self.stage.src is None:
+            channel = self.mixer.channels[self.stage.dst]
+            following = self._next(self.stage.dst)
+            if channel.stage() == TransitionStage.POST and \
+                    self.mixer.channels[following].song is not None:
+                # The first song has faded in and we can now enable
+                # transitions to the next channel
+                self.stage = MixerStage(self.stage.dst, following)
 
     def get_master_channel(self) -> TargetChannel:
-        channel_a = self.mixer.channels[0]
-        stage_a = channel_a.stage()
-        channel_b = self.mixer.channels[1]
-        stage_b = channel_b.stage()
-
-        if self.stage == MixerStage.INIT_A:
-            return TargetChannel.A
-        elif self.stage == MixerStage.A_TO_B:
-            if stage_b in [TransitionStage.NONE, TransitionStage.PRE]:
-                return TargetChannel.A
-            else:
-                return TargetChannel.B
-        elif self.stage == MixerStage.B_TO_A:
-            if stage_a in [TransitionStage.NONE, TransitionStage.PRE]:
-                return TargetChannel.B
-            else:
-                return TargetChannel.A
+        src, dst = self.stage.src, self.stage.dst
+        if src is None:
+            return TargetChannel(dst + 1)
+        if self.mixer.channels[dst].stage() in [TransitionStage.NONE,
+                                                TransitionStage.PRE]:
+            return TargetChannel(src + 1)
+        return TargetChannel(dst + 1)
 
     def _apply_transition(self, qd: QueueData, channel_src: Channel,
             channel_dst: Channel):
@@ -86,167 +145,207 @@ class MixerFSM:
         channel_dst.transition_bars = qd.selection_dst
 
         # Compute the transition function
-        channel_src.transition = create_transition_func(self.mixer,
-            qd.transition_src, pa, qa, inp=False)
-        channel_dst.transition = create_transition_func(self.mixer,
-            qd.transition_dst, pb, qb, inp=True)
+        channel_src.transition = qd.transition_src.automate(pa, qa,
+            inp=False)
+        channel_dst.transition = qd.transition_dst.automate(pb, qb, inp=True)
 
         # Match both selections
-        bars_to_transition = qd.selection_src[0] - song_src.time_to_bar(
-            channel_src.time)
-        channel_dst.play(
-            song_dst.bar_to_time(qd.selection_dst[0] - bars_to_transition))
+        self._play_in_sync(channel_dst, qd.selection_dst[0], channel_src,
+            qd.selection_src[0])
+
+    @staticmethod
+    def _play_in_sync(channel: Channel, bar: int, master: Channel,
+            master_bar: int):
+        """
+        Plays the channel so that its bar `bar` starts together with the bar
+        `master_bar` of the playing master channel.
+        """
+        bars_to_transition = master_bar - master.song.time_to_bar(master.time)
+        channel.play(channel.song.bar_to_time(bar - bars_to_transition))
 
     def load(self, song: Song, dry: bool = False) -> Optional[TargetChannel]:
         """
         Plays the song in the suitable channel. If `dry` the channel is
         returned without executing the operation.
         """
+        channels = self.mixer.channels
+        src, dst = self.stage.src, self.stage.dst
+        target = None
 
-        channel_a = self.mixer.channels[0]
-        stage_a = channel_a.stage()
-        channel_b = self.mixer.channels[1]
-        stage_b = channel_b.stage()
-
-        if self.stage == MixerStage.INIT_A:
-            if channel_a.song is None:
-                if dry:
-                    return TargetChannel.A
-                # No song loaded yet
-                channel_a.load(song)
+        if src is None:
+            channel = channels[dst]
+            following = self._next(dst)
+            if channel.song is None or channel.stage() == \
+                    TransitionStage.NONE:
+                # No song loaded yet or the song is not queued, so we
+                # (re)load the first channel
+                target = dst
             else:
-                # A is loaded but B is missing
-                if stage_a == TransitionStage.NONE:
-                    if dry:
-                        return TargetChannel.A
-                    # A is not queued so we reload A instead of loading B
-                    channel_a.load(song)
-                else:
-                    if dry:
-                        return TargetChannel.B
-                    # A is queued, now we load B
-                    channel_b.load(song)
-                    if stage_a == TransitionStage.POST:
-                        # A has faded in, we can now enable transitions A to B
-                        self.stage = MixerStage.A_TO_B
-        elif self.stage == MixerStage.A_TO_B:
-            if stage_a == TransitionStage.POST:
-                if stage_b == TransitionStage.NONE:
-                    if dry:
-                        return TargetChannel.B
-                    # B is not playing so we can still load other songs in B
-                    channel_b.load(song)
-                elif stage_b == TransitionStage.POST:
-                    if dry:
-                        return TargetChannel.A
-                    # We transitioned from A to B, now A can be loaded again
-                    channel_a.load(song)
-                    self.stage = MixerStage.B_TO_A
-        elif self.stage == MixerStage.B_TO_A:
-            if stage_b == TransitionStage.POST:
-                if stage_a == TransitionStage.NONE:
-                    if dry:
-                        return TargetChannel.A
-                    # A is not playing so we can still load other songs in A
-                    channel_a.load(song)
-                elif stage_a == TransitionStage.POST:
-                    if dry:
-                        return TargetChannel.B
-                    # We transitioned from B to A, now B can be loaded
-                    channel_b.load(song)
-                    self.stage = MixerStage.A_TO_B
+                # The first channel is queued, now we load the next one
+                target = following
+                if not dry and channel.stage() == TransitionStage.POST:
+                    # It has faded in, we can now enable transitions
+                    self.stage = MixerStage(dst, following)
+        elif channels[src].stage() == TransitionStage.POST:
+            stage_dst = channels[dst].stage()
+            if stage_dst == TransitionStage.NONE:
+                # The destination is not playing so we can still load other
+                # songs into it
+                target = dst
+            elif stage_dst == TransitionStage.POST:
+                # We transitioned to the destination, now the following
+                # channel can be loaded
+                target = self._next(dst)
+                if not dry:
+                    self.stage = MixerStage(dst, target)
+
         if dry:
-            # No load possible
-            return TargetChannel.INVALID
+            # INVALID if no load is possible
+            return TargetChannel(target + 1 if target is not None else 0)
+        if target is not None:
+            channels[target].load(song)
 
     def cancel(self, dry: bool = False) -> Optional[TargetChannel]:
         """
         Cancels the queued transition in the suitable channel. If `dry`
         the channel is returned without executing the operation.
         """
-        channel_a = self.mixer.channels[0]
-        stage_a = channel_a.stage()
-        channel_b = self.mixer.channels[1]
-        stage_b = channel_b.stage()
+        src, dst = self.stage.src, self.stage.dst
 
-        if self.stage == MixerStage.INIT_A:
-            # We can't cancel in init (theres at most one song playing)
-            pass
-        elif self.stage == MixerStage.A_TO_B:
-            if stage_a == TransitionStage.PRE:
-                if dry:
-                    return TargetChannel.B
-                # A has not started mixing yet so we can still cancel B
-                channel_a.clear_transition()
-                channel_b.load(channel_b.song)
-        elif self.stage == MixerStage.B_TO_A:
-            if stage_b == TransitionStage.PRE:
-                if dry:
-                    return TargetChannel.A
-                # B has not started mixing yet so we can still cancel A
-                channel_b.clear_transition()
-                channel_a.load(channel_a.song)
+        # We can't cancel in init (theres at most one song playing)
+        if src is not None and self.mixer.channels[src].stage() == \
+                TransitionStage.PRE:
+            if dry:
+                return TargetChannel(dst + 1)
+            # The source has not started mixing yet so we can still cancel
+            # the destination
+            self.mixer.channels[src].clear_transition()
+            channel_dst = self.mixer.channels[dst]
+            channel_dst.load(channel_dst.song)
         if dry:
             return TargetChannel.INVALID
 
+    def create_queue_data(self, transitions: List[CompiledTransition],
+            selections: List[List[int]]) -> QueueData:
+        """
+        Creates the data to queue a transition from the transitions and the
+        selected bars of every channel. The channel that fades out applies
+        its transition backwards.
+        """
+        stage = self.queue(None, dry=True)
+        if stage.src is None:
+            dst = stage.dst if stage.dst is not None else 0
+            return QueueData(transitions[dst], None, selections[dst], None)
+        return QueueData(transitions[stage.src], transitions[stage.dst],
+            selections[stage.src], selections[stage.dst])
+
     def queue(self, qd: QueueData, dry: bool = False) -> Optional[MixerStage]:
         """
         Queues the transition. If `dry` the direction of the transition is
         returned without executing the operation.
         """
-        channel_a = self.mixer.channels[0]
-        stage_a = channel_a.stage()
-        channel_b = self.mixer.channels[1]
-        stage_b = channel_b.stage()
-
-        song_a = channel_a.song
-        song_b = channel_b.song
+        channels = self.mixer.channels
+        src, dst = self.stage.src, self.stage.dst
 
-        if self.stage == MixerStage.INIT_A:
-            if song_a is not None and song_b is None and stage_a == \
-                    TransitionStage.NONE:
-                if dry:
-                    return MixerStage.INIT_A
-                # Only A is loaded and not playing yet, so we play it and
-                # transition from "nothing" immediately
-                p = song_a.bar_to_time(qd.selection_src[0])
-                q = song_a.bar_to_time(qd.selection_src[1] + 1)
-                channel_a.transition_bars = qd.selection_src
-                channel_a.transition = create_transition_func(self.mixer,
-                    qd.transition_src, p, q, inp=True)
-                print(qd)
-                channel_a.play(p)
-        elif self.stage == MixerStage.A_TO_B:
-            if stage_a == TransitionStage.POST and stage_b == \
+        if src is None:
+            channel = channels[dst]
+            if channel.song is not None and channels[
+                    self._next(dst)].song is None and channel.stage() == \
                     TransitionStage.NONE:
                 if dry:
-                    return MixerStage.A_TO_B
-                # A is playing and B is not, so we transition from A to B
-                # and start playing B
-                self._apply_transition(qd, channel_a, channel_b)
-            elif stage_a == TransitionStage.POST and stage_b == \
-                    TransitionStage.POST:
-                if dry:
-                    return MixerStage.B_TO_A
-                # Both A and B are playing and we transitioned from A to B
-                # We therefore transition back from B to A
-                self._apply_transition(qd, channel_b, channel_a)
-                self.stage = MixerStage.B_TO_A
-        elif self.stage == MixerStage.B_TO_A:
-            if stage_a == TransitionStage.NONE and stage_b == \
-                    TransitionStage.POST:
+                    return self.stage
+                # Only the first song is loaded and not playing yet, so we
+                # play it and transition from "nothing" immediately
+                p = channel.song.bar_to_time(qd.selection_src[0])
+                q = channel.song.bar_to_time(qd.selection_src[1] + 1)
+                channel.transition_bars = qd.selection_src
+                channel.transition = qd.transition_src.automate(p, q,
+                    inp=True)
+                channel.play(p)
+        elif channels[src].stage() == TransitionStage.POST:
+            stage_dst = channels[dst].stage()
+            if stage_dst == TransitionStage.NONE:
                 if dry:
-                    return MixerStage.B_TO_A
-                # B is playing and A is not, so we transition from B to A
-                # and start playing A
-                self._apply_transition(qd, channel_b, channel_a)
-            elif stage_a == TransitionStage.POST and stage_b == \
-                    TransitionStage.POST:
+                    return self.stage
+                # The source is playing and the destination is not, so we
+                # transition to the destination and start playing it
+                self._apply_transition(qd, channels[src], channels[dst])
+            elif stage_dst == TransitionStage.POST:
                 if dry:
-                    return MixerStage.A_TO_B
-                # Both A and B are playing and we transitioned from B to A
-                # We therefore transition back from A to B
-                self._apply_transition(qd, channel_a, channel_b)
-                self.stage = MixerStage.A_TO_B
+                    return MixerStage(dst, src)
+                # Both are playing and we transitioned to the destination
+                # We therefore transition back to the source
+                self._apply_transition(qd, channels[dst], channels[src])
+                self.stage = MixerStage(dst, src)
         if dry:
             return MixerStage.INVALID
+
+    def load_layer(self, index: int, song: Song,
+            dry: bool = False) -> Optional[TargetChannel]:
+        """
+        Loads the song into the layer unless the layer is playing. If `dry`
+        the channel is returned without executing the operation.
+        """
+        valid = self._is_layer(index) and not self.mixer.channels[
+            index].is_playing
+        if dry:
+            return TargetChannel(index + 1 if valid else 0)
+        if valid:
+            self.mixer.channels[index].load(song)
+
+    def queue_layer(self, index: int, qd: LayerQueueData,
+            dry: bool = False) -> Optional[LayerAction]:
+        """
+        Fades the loaded layer in, starting the selection with the selected
+        bars of the master channel, or fades the playing layer out over the
+        selection. If `dry` the action is returned without executing it.
+        """
+        if not self._is_layer(index):
+            return LayerAction.INVALID if dry else None
+        channel = self.mixer.channels[index]
+        master = self.mixer.channels[self.get_master_channel().value - 1]
+
+        if channel.song is not None and not channel.is_playing and \
+                master.is_playing:
+            if dry:
+                return LayerAction.FADE_IN
+            p = channel.song.bar_to_time(qd.selection[0])
+            q = channel.song.bar_to_time(qd.selection[1] + 1)
+            channel.transition_bars = qd.selection
+            channel.transition = qd.transition.automate(p, q, inp=True)
+            self._play_in_sync(channel, qd.selection[0], master,
+                qd.selection_master[0])
+        elif channel.stage() == TransitionStage.POST and \
+                index not in self.fading_out:
+            if dry:
+                return LayerAction.FADE_OUT
+            p = channel.song.bar_to_time(qd.selection[0])
+            q = channel.song.bar_to_time(qd.selection[1] + 1)
+            channel.transition_bars = qd.selection
+            channel.transition = qd.transition.automate(p, q, inp=False)
+            self.fading_out.add(index)
+        if dry:
+            return LayerAction.INVALID
+
+    def cancel_layer(self, index: int,
+            dry: bool = False) -> Optional[LayerAction]:
+        """
+        Cancels the queued transition of the layer unless it has started. If
+        `dry` the action that would be cancelled is returned without
+        executing the operation.
+        """
+        if not self._is_layer(index) or self.mixer.channels[
+                index].stage() != TransitionStage.PRE:
+            return LayerAction.INVALID if dry else None
+        channel = self.mixer.channels[index]
+        if index in self.fading_out:
+            if dry:
+                return LayerAction.FADE_OUT
+            # The layer keeps playing
+            channel.clear_transition()
+            self.fading_out.discard(index)
+        else:
+            if dry:
+                return LayerAction.FADE_IN
+            # The layer is still silent
+            channel.stop()
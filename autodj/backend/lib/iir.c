@@ -1,34 +1,68 @@
 // Adjust this for MSVC if necessary
 #define EXPORT __attribute__((__visibility__("default")))
 
-#define NUM_CHAN 2
+// Number of coefficients per section (b0, b1, b2, a1, a2)
+#define NUM_COEF 5
 
-struct sample_t
-{
-    float chan[NUM_CHAN];
-};
-
-EXPORT void iir(
+/*
+ * Filters interleaved samples of `num_chan` channels with a cascade of
+ * `num_sections` biquads (transposed direct form II).
+ *
+ * The coefficients are interpolated linearly between the entries of
+ * `coef_table` (`resolution` x `num_sections` x NUM_COEF, normalized by a0)
+ * at the position given by `params` (between 0 and 1) for every sample.
+ *
+ * `state` (`num_sections` x 2 x `num_chan`) is updated, so consecutive
+ * blocks are filtered continuously. Input and output may be the same.
+ */
+EXPORT void biquad(
     const float *coef_table,
-    int coef_len,
-    const int *coef_indices,
-    const struct sample_t *input,
-    struct sample_t *output,
-    int num_samples)
+    int resolution,
+    int num_sections,
+    const float *params,
+    float *state,
+    const float *input,
+    float *output,
+    int num_samples,
+    int num_chan)
 {
-    for (int i = coef_len; i < num_samples; i++)
+    const int stride = num_sections * NUM_COEF;
+    for (int i = 0; i < num_samples; i++)
     {
-        struct sample_t tmp = {0};
-        output[i] = tmp;
-        const float *b = &coef_table[coef_indices[i] * coef_len * 2];
-        const float *a = b + coef_len;
-        for (int j = 0; j < coef_len; j++)
+        // Find the neighbouring table entries
+        float pos = params[i] * (resolution - 1);
+        if (pos < 0)
+            pos = 0;
+        if (pos > resolution - 1)
+            pos = resolution - 1;
+        int k = (int)pos;
+        if (k > resolution - 2)
+            k = resolution > 1 ? resolution - 2 : 0;
+        const float frac = resolution > 1 ? pos - k : 0;
+        const float *c0 = &coef_table[k * stride];
+        const float *c1 = resolution > 1 ? c0 + stride : c0;
+
+        const float *x = &input[i * num_chan];
+        float *y = &output[i * num_chan];
+        for (int c = 0; c < num_chan; c++)
+            y[c] = x[c];
+
+        for (int s = 0; s < num_sections; s++)
         {
-            for (int c = 0; c < NUM_CHAN; c++)
+            float coef[NUM_COEF];
+            for (int j = 0; j < NUM_COEF; j++)
+                coef[j] = c0[s * NUM_COEF + j] + frac * (c1[s * NUM_COEF + j] - c0[s * NUM_COEF + j]);
+
+            float *z1 = &state[s * 2 * num_chan];
+            float *z2 = z1 + num_chan;
+            for (int c = 0; c < num_chan; c++)
             {
-                tmp.chan[c] += b[j] * input[i - j].chan[c] - a[j] * output[i - j].chan[c];
+                const float in = y[c];
+                const float out = coef[0] * in + z1[c];
+                z1[c] = coef[1] * in - coef[3] * out + z2[c];
+                z2[c] = coef[2] * in - coef[4] * out;
+                y[c] = out;
             }
         }
-        output[i] = tmp;
     }
 }
@@ -0,0 +1,239 @@
+# library: Indexes the songs in the library in the background.
+
+import fnmatch
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Optional
+
+from autodj.backend.analysis import ANALYSIS_VERSION
+from autodj.backend.audio import AudioFile
+from autodj.backend.cache import CACHE_DIR, load_analysis, write_atomic
+from autodj.backend.search import SongSearch
+from autodj.backend.song import Song, get_artist_and_title
+from autodj.backend.watch import create_watcher
+
+SONG_DIR = 'data/songs'
+SONG_EXTENSIONS = ['*.wav', '*.mp3', '*.mp4']
+
+
+def find_songs(directory: str = SONG_DIR) -> List[str]:
+    """
+    Returns the files of all songs in the directory.
+    """
+    files = []
+    for ext in SONG_EXTENSIONS:
+        files.extend(glob.glob(os.path.join(directory, ext)))
+    return files
+
+
+def analyze_file(file: str) -> dict:
+    """
+    Decodes and analyzes a song, which also fills the analysis cache.
+    Returns the results of the analysis. This runs in a worker process.
+    """
+    cached = load_analysis(file, ANALYSIS_VERSION)
+    if cached is not None:
+        del cached['waveform']
+        return cached
+    # The songs are already analyzed in parallel. Only the analysis is
+    # cached, the decoded signals of a whole library would not fit on disk.
+    song = Song(file, parallel=False, cache=False)
+    song.analyzed.wait()
+    return song.get_analysis()
+
+
+class LibraryIndexer:
+    """
+    Analyzes all songs of the library using a pool of worker processes and
+    keeps the results (BPM, length and key) in a persistent index. After the
+    initial scan, the index is updated incrementally whenever songs are
+    added, changed or removed, and it can be searched.
+    """
+
+    # Number of analyzed songs after which the index is saved
+    SAVE_INTERVAL = 16
+
+    def __init__(self, directory: str = SONG_DIR,
+            index_file: str = os.path.join(CACHE_DIR, 'library.json'),
+            workers: Optional[int] = None):
+        self.directory = directory
+        self.index_file = index_file
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.entries: Dict[str, dict] = {}
+        self.search = SongSearch()
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.done = 0
+        self.total = 0
+        self.running = False
+
+        try:
+            with open(index_file) as j:
+                self.entries = json.load(j)
+        except (OSError, ValueError):
+            pass
+
+    def start(self):
+        """
+        Starts indexing and watching the library in a background thread.
+        """
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def progress(self) -> dict:
+        """
+        Returns the progress of the indexer and the version of the search
+        index (which changes whenever songs are added, changed or removed).
+        """
+        return {'done': self.done, 'total': self.total,
+                'running': self.running, 'version': self.search.version}
+
+    def _is_current(self, file: str) -> bool:
+        entry = self.entries.get(file)
+        if entry is None:
+            return False
+        stat = os.stat(file)
+        return entry['version'] == ANALYSIS_VERSION and entry['mtime'] == \
+               stat.st_mtime_ns and entry['size'] == stat.st_size
+
+    def _song(self, file: str) -> dict:
+        """
+        Returns the song as listed (with BPM, length and key if indexed).
+        """
+        artist, title = get_artist_and_title(file)
+        song = {'file': file, 'artist': artist, 'title': title, 'bpm': None,
+                'length': None, 'key': None}
+        entry = self.entries.get(file)
+        if entry is not None:
+            song.update({'bpm': entry['bpm'],
+                         'length': entry['length'] / AudioFile.SAMPLE_RATE,
+                         'key': entry['key']})
+        return song
+
+    def _add(self, file: str, analysis: dict):
+        stat = os.stat(file)
+        with self.lock:
+            self.entries[file] = {'version': ANALYSIS_VERSION,
+                                  'mtime': stat.st_mtime_ns,
+                                  'size': stat.st_size, 'bpm': analysis['bpm'],
+                                  'length': analysis['length'],
+                                  'key': analysis['key']}
+        self.search.update(self._song(file))
+
+    def _save(self):
+        with self.lock:
+            data = json.dumps(self.entries).encode()
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        write_atomic(self.index_file, data)
+
+    def _create_pool(self) -> ProcessPoolExecutor:
+        # Spawn the workers since forking a multi-threaded server is unsafe
+        return ProcessPoolExecutor(max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'))
+
+    def _analyzed(self, file: str, future: Future):
+        """
+        Adds the analysis of a song to the index once a worker finished.
+        """
+        try:
+            self._add(file, future.result())
+        except Exception:
+            logging.exception(f'Could not index {file}')
+        with self.lock:
+            self.done += 1
+            self.running = self.done < self.total
+            save = self.done % LibraryIndexer.SAVE_INTERVAL == 0 or \
+                   not self.running
+        if save:
+            self._save()
+        if not self.running:
+            logging.info('Indexing finished')
+
+    def _update(self, file: str):
+        """
+        Lists a new or changed song and analyzes it unless the index is
+        current.
+        """
+        self.search.update(self._song(file))
+        if self._is_current(file):
+            return
+        with self.lock:
+            self.total += 1
+            self.running = True
+        try:
+            future = self.pool.submit(analyze_file, file)
+        except BrokenProcessPool:
+            # A worker died (e.g., killed by the OOM killer), so replace the
+            # pool
+            logging.warning('Restarting the indexing workers')
+            self.pool = self._create_pool()
+            future = self.pool.submit(analyze_file, file)
+        future.add_done_callback(lambda f: self._analyzed(file, f))
+
+    def _remove(self, file: str):
+        with self.lock:
+            self.entries.pop(file, None)
+        self.search.remove(file)
+        self._save()
+
+    def _scan(self):
+        """
+        Lists all songs and analyzes the new or changed ones.
+        """
+        files = find_songs(self.directory)
+        existing = set(files)
+        for file in set(self.search.songs) - existing:
+            self.search.remove(file)
+        with self.lock:
+            self.entries = {f: e for f, e in self.entries.items() if
+                            f in existing}
+        for file in files:
+            self._update(file)
+
+    def _changed(self, file: Optional[str], exists: bool):
+        """
+        Called by the watcher whenever a file was added, changed or removed.
+        """
+        if file is None:
+            logging.info('Rescanning the library')
+            self._scan()
+        elif any(fnmatch.fnmatch(file, ext) for ext in SONG_EXTENSIONS):
+            if not exists:
+                logging.info(f'Removed {file}')
+                self._remove(file)
+            elif os.path.exists(file):
+                logging.info(f'Updated {file}')
+                self._update(file)
+
+    def run(self):
+        """
+        Indexes all songs that are new or changed since the last run and
+        watches the library for changes afterwards.
+        """
+        self.pool = self._create_pool()
+        os.makedirs(self.directory, exist_ok=True)
+        watcher = create_watcher(self.directory,
+            lambda: find_songs(self.directory))
+
+        self._scan()
+        logging.info(f'Indexing {self.total} of {len(self.search.songs)} '
+                     f'songs')
+        with self.lock:
+            self.running = self.done < self.total
+        if not self.running:
+            self._save()
+        watcher.run(self._changed)
+
+    def songs(self) -> List[dict]:
+        """
+        Returns all songs of the library including artist, title and (if
+        already indexed) BPM, length and key.
+        """
+        with self.search.lock:
+            return list(self.search.songs.values())
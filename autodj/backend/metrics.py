@@ -0,0 +1,118 @@
+# metrics: Instrumentation of the real-time render path.
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Deque, Optional
+
+import numpy as np
+
+
+class RenderMetrics:
+    """
+    Records the duration of every stage of every block (e.g., stretching or
+    a single effect) as well as audio driver underflows. Keeps a rolling
+    history that is summarized as histograms and can optionally dump every
+    block as a JSON line to a file for offline analysis.
+    """
+
+    # Upper bounds of the histogram bins (in milliseconds)
+    BINS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')]
+    # Number of blocks in the rolling history
+    HISTORY = 512
+
+    def __init__(self, dump_file: Optional[str] = None,
+            history: int = HISTORY):
+        self.history_size = history
+        self.history: Dict[str, Deque[float]] = {}
+        self.current: Dict[str, float] = {}
+        self.blocks = 0
+        self.underflows = 0
+        # Stages may be measured by multiple render threads
+        self.lock = threading.Lock()
+
+        # Dump the blocks from a separate thread to keep file I/O out of the
+        # audio thread
+        self.dump: Optional[queue.SimpleQueue] = None
+        if dump_file is not None:
+            self.dump = queue.SimpleQueue()
+            threading.Thread(target=self._write_dump, args=(dump_file,),
+                daemon=True).start()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures the duration of a stage of the current block. Stages with
+        the same name are accumulated.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, duration: float):
+        """
+        Records the duration of a stage of the current block that was
+        measured elsewhere.
+        """
+        with self.lock:
+            self.current[name] = self.current.get(name, 0.0) + duration
+
+    def underflow(self):
+        """
+        Records an underflow reported by the audio driver.
+        """
+        self.underflows += 1
+
+    def end_block(self, block_time: float, block_size: int):
+        """
+        Moves the stages of the current block into the history.
+        """
+        for name, duration in self.current.items():
+            if name not in self.history:
+                self.history[name] = deque(maxlen=self.history_size)
+            self.history[name].append(duration)
+        if self.dump is not None:
+            self.dump.put({'time': block_time, 'block_size': block_size,
+                           'underflows': self.underflows,
+                           'stages': self.current})
+        self.current = {}
+        self.blocks += 1
+
+    def reset(self):
+        self.history = {}
+        self.current = {}
+        self.blocks = 0
+        self.underflows = 0
+
+    def summary(self) -> dict:
+        """
+        Summarizes the history of every stage as histogram (number of blocks
+        per bin in `bins`) and percentiles (in milliseconds).
+        """
+        stages = {}
+        # Copying is atomic with respect to the audio thread (GIL)
+        for name, durations in list(self.history.items()):
+            ms = np.asarray(tuple(durations)) * 1000
+            if ms.shape[0] == 0:
+                continue
+            hist = np.histogram(ms, [0] + RenderMetrics.BINS)[0]
+            stages[name] = {'histogram': hist.tolist(),
+                            'mean': float(np.mean(ms)),
+                            'p50': float(np.percentile(ms, 50)),
+                            'p99': float(np.percentile(ms, 99)),
+                            'max': float(np.max(ms))}
+        return {'bins': RenderMetrics.BINS[:-1] + ['inf'],
+                'blocks': self.blocks, 'underflows': self.underflows,
+                'stages': stages}
+
+    def _write_dump(self, dump_file: str):
+        with open(dump_file, 'a') as f:
+            while True:
+                f.write(json.dumps(self.dump.get()) + '\n')
+                if self.dump.empty():
+                    f.flush()
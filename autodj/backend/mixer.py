@@ -1,15 +1,21 @@
 import inspect
-import multiprocessing
-from typing import Dict
+import logging
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Deque, Tuple, Callable, Any, Type, Optional
 
 import numpy as np
 import pyaudio
-import pyrubberband
 
 import autodj.backend.effects
 from autodj.backend.audio import AudioFile
-from autodj.backend.channel import Channel
-from autodj.backend.fsm import MixerFSM
+from autodj.backend.channel import Channel, TransitionStage, \
+    create_transition_func
+from autodj.backend.fsm import MixerFSM, MAX_CHANNELS, MAIN_CHANNELS
+from autodj.backend.metrics import RenderMetrics
+from autodj.backend.song import Song
+from autodj.backend.stretch import Stretcher, WsolaStretcher
 
 
 def get_all_effects() -> Dict[str, autodj.backend.effects.Effect]:
@@ -27,110 +33,321 @@ class Mixer:
     """
     Implements the mixer that is responsible for playback and mixing.
     """
+    # Default block size (in samples)
     BUFFER_SIZE = 12000
-    TRANSIENT_SIZE = 1000
 
-    def __init__(self):
+    # Block sizes tried by the calibration (in increasing order)
+    BLOCK_SIZES = [1024, 2048, 3072, 4096, 6144, 8192, 12000, 16384]
+    # Number of blocks rendered per block size during calibration
+    CALIBRATION_BLOCKS = 16
+    # Number of recent blocks considered for the render time
+    RENDER_HISTORY = 64
+
+    # Maximum time to wait for the result of a control operation (in seconds)
+    COMMAND_TIMEOUT = 5.0
+
+    def __init__(self, stretcher: Type[Stretcher] = WsolaStretcher,
+            block_size: int = BUFFER_SIZE, adaptive: bool = False,
+            margin: float = 0.5, metrics_file: Optional[str] = None,
+            stream: bool = True, lookahead: bool = True,
+            num_channels: int = 2, threads: Optional[int] = None):
         """
-        Initializes the mixer.
+        Initializes the mixer. The channels use the given type of time
+        stretcher.
+
+        If `adaptive`, the block size is determined by `calibrate`, otherwise
+        `block_size` is used. `margin` is the fraction of the block duration
+        that should remain unused by rendering. The render metrics of every
+        block are appended to `metrics_file` if given.
+
+        If not `stream`, no audio stream is opened and blocks are pulled by
+        calling `produce` instead (e.g., for benchmarks or offline rendering).
+        If not `lookahead`, the channels stretch every block inline.
+
+        The mixer has `num_channels` channels (decks): the main channels A
+        and B and further layers on top of them (see `MixerFSM`). The playing
+        channels are rendered in parallel by up to `threads` threads (by
+        default one per channel).
         """
+        if not MAIN_CHANNELS <= num_channels <= MAX_CHANNELS:
+            raise ValueError(f'The number of channels must be between '
+                             f'{MAIN_CHANNELS} and {MAX_CHANNELS}')
         self.global_time = 0
         self.global_bpm = 130
+        self.block_size = block_size
+        self.margin = margin
+        self.render_times: Deque[float] = deque(maxlen=Mixer.RENDER_HISTORY)
+        # Number of effect blocks that were bypassed since they were neutral
+        self.skipped_effects = 0
+        self.metrics = RenderMetrics(metrics_file)
+        # Output block (reused by `produce`)
+        self.master: np.ndarray = None
 
-        self.channels = [Channel(), Channel()]
-
-        self.lock = multiprocessing.Lock()
+        self.channels = [Channel(stretcher, lookahead) for _ in
+                         range(num_channels)]
+        # Renders the channels in parallel (the heavy work in NumPy, SciPy
+        # and the C filters releases the GIL)
+        threads = min(threads or num_channels, num_channels)
+        self.pool = ThreadPoolExecutor(threads, 'render') if threads > 1 \
+            else None
 
-        # Square-rooted equal power cross-fade to reduce transients between
-        # blocks
-        self.fade_in = np.repeat(
-            [np.sqrt(np.linspace(0, 1, Mixer.TRANSIENT_SIZE))], 2, axis=0).T
-        self.fade_out = np.repeat(
-            [np.sqrt(np.linspace(1, 0, Mixer.TRANSIENT_SIZE))], 2, axis=0).T
+        # Control operations from the API that are applied by the audio
+        # thread at the start of the next block (appending and popping is
+        # atomic, so the audio thread never waits for the server)
+        self.commands: Deque[Tuple[Callable[[], Any], Future]] = deque()
 
         # Setup the finite state machine that controls the mixer
         self.fsm = MixerFSM(self)
 
         self.all_effects = get_all_effects()
 
+        # Snapshot of the state for the status API, updated after every block
+        self.status = self._snapshot()
+        self.status_seq = 0
+
+        if adaptive:
+            self.block_size = self.calibrate()
+            self.status = self._snapshot()
+        logging.info(f'Block size {self.block_size} '
+                     f'({self.block_size / AudioFile.SAMPLE_RATE * 1000:.1f}'
+                     f' ms)')
+
         # Setup audio driver
-        self.audio = pyaudio.PyAudio()
-        self.stream = self.audio.open(format=pyaudio.paFloat32, channels=2,
-            rate=AudioFile.SAMPLE_RATE, frames_per_buffer=Mixer.BUFFER_SIZE,
-            output=True, input=False, stream_callback=lambda x, y, z, w: (
-                self.produce(), pyaudio.paContinue))
+        self.audio = None
+        self.stream = None
+        if stream:
+            self.audio = pyaudio.PyAudio()
+            self.stream = self.audio.open(format=pyaudio.paFloat32,
+                channels=2, rate=AudioFile.SAMPLE_RATE,
+                frames_per_buffer=self.block_size, output=True, input=False,
+                stream_callback=self._callback)
+
+            self.stream.start_stream()
+
+    def calibrate(self) -> int:
+        """
+        Determines the smallest block size whose render time keeps the safety
+        margin. Synthetic songs are rendered on all channels: the main
+        channels transition with every effect active and the layers play on
+        top. The slowest block (including the inline stretching of the first
+        block) is compared against the block duration.
+        """
+        song = Song.synthesize()
+        trans = dict((fx, [[0, 0.5], [1, 0.5]]) for fx in self.all_effects)
+        block_size = Mixer.BLOCK_SIZES[-1]
+        for block_size in Mixer.BLOCK_SIZES:
+            self.block_size = block_size
+            for i, channel in enumerate(self.channels):
+                channel.load(song)
+                channel.play(0)
+                if i < MAIN_CHANNELS:
+                    channel.transition = create_transition_func(self, trans,
+                        0, song.length / AudioFile.SAMPLE_RATE, inp=True)
+            for _ in range(Mixer.CALIBRATION_BLOCKS):
+                self.produce()
 
-        self.stream.start_stream()
+            render_time = max(self.render_times)
+            budget = block_size / AudioFile.SAMPLE_RATE * (1 - self.margin)
+            logging.info(f'Calibration: block size {block_size} renders in '
+                         f'{render_time * 1000:.1f} ms (budget '
+                         f'{budget * 1000:.1f} ms)')
+            self.render_times.clear()
+            self.metrics.reset()
+            if render_time <= budget:
+                break
+
+        # Reset the mixer
+        for channel in self.channels:
+            channel.clear()
+        self.global_time = 0
+        self.fsm = MixerFSM(self)
+        return block_size
+
+    def close(self):
+        """
+        Stops the audio stream and ends the background threads of the
+        channels and the render pool.
+        """
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.audio.terminate()
+            self.stream = None
+        for channel in self.channels:
+            channel.renderer.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def submit(self, command: Callable[[], Any]) -> Future:
+        """
+        Schedules a control operation (e.g., an FSM operation) that is
+        applied before the next block is produced. Returns a future for the
+        result of the operation.
+        """
+        future = Future()
+        self.commands.append((command, future))
+        return future
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        """
+        Called by PyAudio whenever the next block is needed.
+        """
+        if status & pyaudio.paOutputUnderflow:
+            self.metrics.underflow()
+        return self.produce(), pyaudio.paContinue
 
     def produce(self) -> np.ndarray:
         """
-        Produces the next block for playback.
-        """
-        master = np.zeros((Mixer.BUFFER_SIZE, 2), dtype=np.float32)
-
-        with self.lock:
-            for channel in self.channels:
-                if not channel.is_playing:
-                    continue
-
-                # Speedup of this song with respect to the global BPM
-                # Find smartest BPM to fade (i.e., with closest speedup to 1)
-                speeds = [self.global_bpm / channel.song.bpm,
-                          self.global_bpm / channel.song.bpm / 2,
-                          self.global_bpm / channel.song.bpm * 2]
-                speed = speeds[np.abs(1 - np.asarray(speeds)).argmin()]
-
-                # Stream twice the signal needed in buffer (in case of heavy
-                # stretching)
-                # Then stretch the signal using pyrubberband
-                src = channel.song.stream(
-                    int(channel.time * AudioFile.SAMPLE_RATE),
-                    int(Mixer.BUFFER_SIZE * 2))
-
-                stretched = pyrubberband.time_stretch(src,
-                    AudioFile.SAMPLE_RATE, speed, {'-R': '-R'}).astype(
-                    np.float32)
-
-                inp = stretched[0:Mixer.BUFFER_SIZE]
-
-                # Reduce transients by cross-fading the future signal of the
-                # last block
-                if channel.transient is not None:
-                    inp[:Mixer.TRANSIENT_SIZE] *= self.fade_in
-                    inp[
-                    :Mixer.TRANSIENT_SIZE] += self.fade_out * channel.transient
-
-                # Update transient for next block
-                channel.transient = stretched[
-                                    Mixer.BUFFER_SIZE:Mixer.BUFFER_SIZE +
-                                                      Mixer.TRANSIENT_SIZE]
-
-                # Apply the effect chain
-                if channel.last is None:
-                    channel.last = np.zeros_like(inp)
-
-                tmp = np.concatenate((channel.last, inp))
-                channel.last[:] = inp[:]
-                inp = tmp
-
-                t = np.linspace(channel.time,
-                    channel.time + Mixer.BUFFER_SIZE * 2 /
-                    AudioFile.SAMPLE_RATE * speed,
-                    inp.shape[0], dtype=np.float32)
-
-                out = np.empty_like(inp)
-                for fx in channel.transition:
-                    param = channel.transition[fx](t)
-                    self.all_effects[fx].apply(inp, out, param, self.global_bpm)
-                    out, inp = inp, out
-
-                channel.time += Mixer.BUFFER_SIZE / AudioFile.SAMPLE_RATE * \
-                                speed
-                master += inp[Mixer.BUFFER_SIZE:]
-
-            self.global_time += Mixer.BUFFER_SIZE / AudioFile.SAMPLE_RATE
-
-            # Update the Finite State Machine
+        Produces the next block for playback. The block is only valid until
+        the next call, since the buffers are reused.
+        """
+        start = time.perf_counter()
+        metrics = self.metrics
+        if self.master is None or self.master.shape[0] != self.block_size:
+            self.master = np.zeros((self.block_size, 2), dtype=np.float32)
+        master = self.master
+        master[:] = 0
+
+        # Apply the pending control operations
+        with metrics.stage('control'):
+            while self.commands:
+                command, future = self.commands.popleft()
+                try:
+                    future.set_result(command())
+                except Exception as e:
+                    logging.exception('Control operation failed')
+                    future.set_exception(e)
+
+        # Render the channels (in parallel if there are multiple)
+        playing = [c for c in self.channels if c.is_playing]
+        if self.pool is not None and len(playing) > 1:
+            results = list(self.pool.map(self._render_channel, playing))
+        else:
+            results = [self._render_channel(c) for c in playing]
+
+        with metrics.stage('master'):
+            for out, skipped in results:
+                self.skipped_effects += skipped
+                if out is not None:
+                    master += out
+
+        self.global_time += self.block_size / AudioFile.SAMPLE_RATE
+
+        # Update the Finite State Machine
+        with metrics.stage('fsm'):
             self.fsm.update()
 
-        return np.clip(master, -1, 1)
+        with metrics.stage('master'):
+            np.clip(master, -1, 1, out=master)
+
+        render_time = time.perf_counter() - start
+        self.render_times.append(render_time)
+        metrics.record('total', render_time)
+        metrics.end_block(self.global_time, self.block_size)
+
+        self.status = self._snapshot()
+        self.status_seq += 1
+
+        return master
+
+    def _render_channel(self, channel: Channel) -> \
+            Tuple[Optional[np.ndarray], int]:
+        """
+        Renders the next block of a playing channel and advances its time.
+        Returns the block (`None` if muted) and the number of bypassed
+        effects. Channels only share read-only data, so they can be rendered
+        concurrently.
+        """
+        metrics = self.metrics
+        skipped = 0
+
+        # Speedup of this song with respect to the global BPM (following
+        # the tempo map of the song)
+        speed = channel.song.speed_at(channel.time, self.global_bpm)
+        duration = self.block_size / AudioFile.SAMPLE_RATE * speed
+
+        # Skip muted channels (e.g., after fading out) unless an effect
+        # still has a tail
+        vol = channel.transition.get('vol')
+        if vol is not None and vol.constant_over(channel.time,
+                channel.time + duration) == 0.0 and all(
+                state is None for state in channel.fx_state.values()):
+            channel.time += duration
+            return None, len(channel.transition)
+
+        # Read the signal stretched to match the global BPM (rendered
+        # ahead in the background)
+        channel.prepare(self.block_size)
+        inp, out = channel.buffers
+        with metrics.stage('stretch'):
+            # The block may have been rendered ahead with other speeds
+            duration = channel.renderer.process(channel.song, channel.time,
+                self.block_size, self.global_bpm, out=inp)
+
+        # Apply the effect chain
+        t = channel.t
+        np.multiply(channel.ramp, duration, out=t)
+        t += channel.time
+        post = channel.stage() == TransitionStage.POST
+        for fx in list(channel.transition):
+            effect = self.all_effects[fx]
+            func = channel.transition[fx]
+            if func.constant_over(channel.time, channel.time + duration) == \
+                    effect.DefaultValue:
+                # Bypass the effect while it is neutral, after the
+                # transition it stays neutral
+                channel.fx_state.pop(fx, None)
+                skipped += 1
+                if post:
+                    del channel.transition[fx]
+                continue
+
+            with metrics.stage('fx:' + fx):
+                if fx not in channel.fx_state:
+                    channel.fx_state[fx] = effect.create_state()
+                param = channel.param
+                func.evaluate(t, param)
+                effect.apply(inp, out, param, self.global_bpm,
+                    channel.fx_state[fx])
+                out, inp = inp, out
+
+        channel.time += duration
+        return inp, skipped
+
+    def _snapshot(self) -> dict:
+        """
+        Takes a snapshot of the global state of the mixer. Must be called
+        from the audio thread.
+        """
+        # Slowest recent block compared to the block duration
+        block_time = self.block_size / AudioFile.SAMPLE_RATE
+        render_time = max(self.render_times, default=0.0)
+
+        layers = []
+        for i in range(MAIN_CHANNELS, len(self.channels)):
+            layers.append({'load': self.fsm.load_layer(i, None, dry=True).name,
+                           'queue': self.fsm.queue_layer(i, None,
+                               dry=True).name,
+                           'cancel': self.fsm.cancel_layer(i, dry=True).name})
+
+        channels = []
+        for channel in self.channels:
+            channels.append({'time': channel.time,
+                             'file': channel.song.file if channel.song is not
+                                                          None else None,
+                             'is_playing': channel.is_playing,
+                             'transition_bars': channel.transition_bars})
+
+        return {'time': self.global_time, 'bpm': self.global_bpm,
+                'channels': channels,
+                'actions': {'load': self.fsm.load(None, dry=True).name,
+                            'cancel': self.fsm.cancel(dry=True).name,
+                            'queue': self.fsm.queue(None, dry=True).name},
+                'stage': self.fsm.stage.name, 'stamp': time.time(),
+                'layers': layers,
+                'master': self.fsm.get_master_channel().name,
+                'render': {'block_size': self.block_size,
+                           'margin': self.margin,
+                           'render_time': render_time,
+                           'headroom': 1 - render_time / block_time,
+                           'skipped_effects': self.skipped_effects}}
@@ -0,0 +1,147 @@
+# search: Searches the songs of the library.
+
+import bisect
+import re
+import threading
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+
+# Characters of which the searchable tokens consist
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# Keys by which the results can be sorted
+SORT_KEYS = ['artist', 'title', 'bpm']
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits a text into lowercase words.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class SongSearch:
+    """
+    Finds songs whose artist or title contain words starting with all words
+    of a query and returns them page by page, sorted by artist, title or
+    BPM.
+
+    Songs are added, updated and removed incrementally. The sorted token
+    list is only rebuilt by the next search after songs were added, removed
+    or renamed. Otherwise, only the sort orders of the changed keys are
+    rebuilt (e.g., the BPM order once the BPM of a song is known).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.songs: Dict[str, dict] = {}
+        self.rows: List[dict] = []
+        # Row of every song (unless the tokens are stale)
+        self.row_of: Dict[str, int] = {}
+        # Sorted tokens and the row each of them belongs to
+        self.tokens: List[str] = []
+        self.token_rows = np.empty(0, dtype=np.int64)
+        # Rows in ascending order per sort key (unknown BPMs last)
+        self.orders: Dict[str, np.ndarray] = {
+            key: np.empty(0, dtype=np.int64) for key in SORT_KEYS}
+        self.known_bpm = 0
+        # Incremented whenever a song is added, changed or removed
+        self.version = 0
+        self.stale_tokens = False
+        # Sort keys whose order must be rebuilt
+        self.stale_orders: Set[str] = set()
+
+    def update(self, song: dict):
+        """
+        Adds or updates a song (with `file`, `artist`, `title` and `bpm`).
+        """
+        with self.lock:
+            old = self.songs.get(song['file'])
+            if old == song:
+                return
+            self.songs[song['file']] = song
+            self.version += 1
+            if old is None or old['artist'] != song['artist'] or \
+                    old['title'] != song['title']:
+                self.stale_tokens = True
+                self.stale_orders.update(SORT_KEYS)
+                return
+            if not self.stale_tokens:
+                self.rows[self.row_of[song['file']]] = song
+            if old['bpm'] != song['bpm']:
+                self.stale_orders.add('bpm')
+
+    def remove(self, file: str):
+        with self.lock:
+            if self.songs.pop(file, None) is not None:
+                self.version += 1
+                self.stale_tokens = True
+                self.stale_orders.update(SORT_KEYS)
+
+    def _rebuild(self):
+        """
+        Rebuilds the stale parts of the index. Must hold the lock.
+        """
+        if self.stale_tokens:
+            self.rows = list(self.songs.values())
+            self.row_of = dict((song['file'], i) for i, song in
+                               enumerate(self.rows))
+            tokens, token_rows = [], []
+            for i, song in enumerate(self.rows):
+                words = set(tokenize(song['artist'] + ' ' + song['title']))
+                tokens.extend(words)
+                token_rows.extend([i] * len(words))
+            order = sorted(range(len(tokens)), key=tokens.__getitem__)
+            self.tokens = [tokens[i] for i in order]
+            self.token_rows = np.asarray(token_rows, dtype=np.int64)[order]
+            self.stale_tokens = False
+
+        # Replace the orders (searches may still use the previous ones)
+        orders = dict(self.orders)
+        if 'artist' in self.stale_orders or 'title' in self.stale_orders:
+            artists = np.asarray([song['artist'].lower() for song in
+                                  self.rows], dtype=str)
+            titles = np.asarray([song['title'].lower() for song in self.rows],
+                dtype=str)
+            orders['artist'] = np.lexsort((titles, artists))
+            orders['title'] = np.lexsort((artists, titles))
+        if 'bpm' in self.stale_orders:
+            bpms = np.asarray([np.nan if song['bpm'] is None else song['bpm']
+                               for song in self.rows], dtype=np.float64)
+            orders['bpm'] = np.argsort(bpms, kind='stable')
+            self.known_bpm = int(np.count_nonzero(~np.isnan(bpms)))
+        self.orders = orders
+        self.stale_orders = set()
+
+    def search(self, query: str, sort: str = 'title', descending: bool = False,
+            offset: int = 0, limit: int = 100) -> Tuple[int, List[dict]]:
+        """
+        Returns the number of songs matching the query and the requested page
+        of them.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f'Unknown sort key {sort}')
+        with self.lock:
+            if self.stale_tokens or self.stale_orders:
+                self._rebuild()
+            rows, tokens, token_rows = self.rows, self.tokens, self.token_rows
+            order = self.orders[sort]
+            known_bpm = self.known_bpm
+
+        if descending:
+            # Songs with unknown BPM stay last
+            split = known_bpm if sort == 'bpm' else len(rows)
+            order = np.concatenate((order[:split][::-1], order[split:]))
+
+        mask = np.ones(len(rows), dtype=bool)
+        for token in set(tokenize(query)):
+            # All tokens with the prefix are consecutive
+            start = bisect.bisect_left(tokens, token)
+            end = bisect.bisect_left(tokens, token + '\U0010ffff', start)
+            match = np.zeros(len(rows), dtype=bool)
+            match[token_rows[start:end]] = True
+            mask &= match
+
+        hits = order[mask[order]]
+        return hits.shape[0], [rows[i] for i in hits[offset:offset + limit]]
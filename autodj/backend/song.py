@@ -2,14 +2,23 @@
 
 import logging
 import os
-from tempfile import NamedTemporaryFile
-from typing import Tuple
+import threading
+from typing import Tuple, Optional, List, Sequence
 
 import numpy as np
-import svgwrite
 
-from autodj.backend.analysis import analyze_song
+from autodj.backend.analysis import analyze_song, detect_key, \
+    compute_tempo_map, ANALYSIS_VERSION
 from autodj.backend.audio import AudioFile
+from autodj.backend.cache import load_analysis, store_analysis
+
+# Number of samples per bin of the finest level of the waveform
+WAVEFORM_BIN = 2048
+# Factor by which the bins grow from one level of the waveform to the next
+WAVEFORM_FACTOR = 4
+# Number of levels of the waveform
+WAVEFORM_LEVELS = 4
+
 
 def get_artist_and_title(file: str) -> Tuple[str, str]:
     """
@@ -24,60 +33,223 @@ def get_artist_and_title(file: str) -> Tuple[str, str]:
         return '', name
 
 
+def waveform_bins(length: int) -> List[int]:
+    """
+    Returns the number of bins of every level of the waveform of a signal
+    with `length` samples.
+    """
+    bins = [max(-(-length // WAVEFORM_BIN), 1)]
+    for _ in range(WAVEFORM_LEVELS - 1):
+        bins.append(-(-bins[-1] // WAVEFORM_FACTOR))
+    return bins
+
+
+def bar_grid(bpm: float, offset: int, length: int,
+        tempo_map: Optional[Sequence[float]]) -> dict:
+    """
+    Returns the start times (in seconds) of the `bars` and `beats` of a song
+    with `length` samples, extrapolated from the tempo map (or BPM and
+    offset) like `Song.bar_to_time` to cover the whole song. `first_bar` is
+    the index of the first bar (negative if the song starts before bar 0).
+    """
+    if tempo_map is None:
+        start = offset / AudioFile.SAMPLE_RATE
+        tempo_map = [start, start + 60 / bpm * 4]
+    tempo_map = np.asarray(tempo_map, dtype=np.float64)
+    first = tempo_map[1] - tempo_map[0]
+    last = tempo_map[-1] - tempo_map[-2]
+    before = max(int(np.ceil(tempo_map[0] / first)), 0)
+    after = max(int(np.ceil((length / AudioFile.SAMPLE_RATE -
+                             tempo_map[-1]) / last)), 0)
+    bars = np.concatenate((tempo_map[0] - first * np.arange(before, 0, -1),
+                           tempo_map, tempo_map[-1] + last * np.arange(1,
+        after + 1)))
+    beats = np.interp(np.arange(0, bars.shape[0] - 1, 0.25),
+        np.arange(bars.shape[0]), bars)
+    return {'first_bar': -before, 'bars': bars.tolist(),
+            'beats': beats.tolist()}
+
+
+def _bar_index(tempo_map: np.ndarray, time: float) -> int:
+    """
+    Returns the index of the bar of the tempo map containing the time (the
+    first or last bar outside the map).
+    """
+    return int(np.clip(np.searchsorted(tempo_map, time, 'right') - 1, 0,
+        tempo_map.shape[0] - 2))
+
+
 class Song(AudioFile):
     """
     Represents a song and stores additional metadata such as BPM and offset.
     """
 
-    def __init__(self, file: str):
+    def __init__(self, file: str, parallel: bool = True,
+            cache: bool = True):
         """
-        Loads a song from a file (wav/mp3).
+        Loads a song from a file (wav/mp3). Without `cache`, the decoded
+        signal is not cached on disk (see `AudioFile`).
+
+        BPM and offset are available once the first minute is decoded. The
+        waveform and the tempo map are computed in the background after
+        the whole song is decoded (the latter in parallel processes if
+        `parallel`), `analyzed` is set when they are available.
         """
-        super().__init__(file)
+        super().__init__(file, cache)
+        self.analyzed = threading.Event()
+        self.parallel = parallel
+        # Start times of all bars (in seconds), until available the bars
+        # follow from BPM and offset
+        self.tempo_map: Optional[np.ndarray] = None
 
         # Determine artist and title from file name by splitting at '-'
         self.artist, self.title = get_artist_and_title(file)
 
-        self.bpm, self.offset = analyze_song(self)
-        self.wave_diagram = self.compute_wave_diagram()
+        # Reuse the analysis from previous runs if possible
+        cached = load_analysis(file, ANALYSIS_VERSION)
+        if cached is not None:
+            self.bpm, self.offset = cached['bpm'], cached['offset']
+            self.key = cached['key']
+            self.waveform = cached['waveform']
+            if cached['tempo_map'] is not None:
+                self.tempo_map = np.asarray(cached['tempo_map'])
+            self.analyzed.set()
+        else:
+            self.bpm, self.offset = analyze_song(self)
+            self.key = detect_key(self)
+            self.waveform = None
+            threading.Thread(target=self._finish_analysis, daemon=True).start()
         logging.info(f'{self.file} (BPM {self.bpm}, offset '
-                     f'{self.offset / AudioFile.SAMPLE_RATE}, length '
-                     f'{self.length / AudioFile.SAMPLE_RATE})')
-
-    def time_to_bar(self, time: float) -> float:
-        return (time - self.offset / AudioFile.SAMPLE_RATE) / (
-                60 / self.bpm * 4)
-
-    def bar_to_time(self, bar: float) -> float:
-        return self.offset / AudioFile.SAMPLE_RATE + bar * 60 / self.bpm * 4
+                     f'{self.offset / AudioFile.SAMPLE_RATE}, key {self.key})')
 
-    def compute_wave_diagram(self, color: str = 'white') -> bytes:
+    @classmethod
+    def from_signal(cls, signal: np.ndarray, file: str = '<signal>',
+            bpm: float = 120.0, offset: int = 0):
+        """
+        Creates a song with known BPM and offset from a signal (see
+        `AudioFile.from_signal`).
         """
-        Computes the wave diagram as SVG and returns the binary data.
+        song = super().from_signal(signal, file)
+        song.artist, song.title = get_artist_and_title(file)
+        song.bpm, song.offset, song.key = bpm, offset, None
+        song.waveform = None
+        song.tempo_map = None
+        song.analyzed = threading.Event()
+        song.analyzed.set()
+        return song
+
+    @classmethod
+    def synthesize(cls, bpm: float = 128.0, length: float = 60.0,
+            seed: int = 0):
         """
-        with NamedTemporaryFile('rb') as file:
-            # 25 pixels per second
-            width = self.length / AudioFile.SAMPLE_RATE * 25
+        Synthesizes a song of `length` seconds with a kick on every beat and
+        a noise background, e.g., for benchmarks without audio files.
+        """
+        rng = np.random.default_rng(seed)
+        num_samples = int(length * AudioFile.SAMPLE_RATE)
+        signal = rng.uniform(-0.1, 0.1, (num_samples, 2)).astype(np.float32)
+
+        # Decaying 60 Hz sine as kick
+        t = np.arange(int(0.2 * AudioFile.SAMPLE_RATE)) / AudioFile.SAMPLE_RATE
+        kick = (np.sin(2 * np.pi * 60 * t) * np.exp(-t * 20)).astype(
+            np.float32)
+        beat = 60 / bpm * AudioFile.SAMPLE_RATE
+        for pos in np.arange(0, num_samples - kick.shape[0], beat).astype(int):
+            signal[pos:pos + kick.shape[0]] += kick[:, None] * 0.9
 
-            # SVG has a height of 100 pixels
-            svg = svgwrite.Drawing(file.name, size=(width, 100))
+        return cls.from_signal(signal, f'Synthetic - {bpm} BPM.wav', bpm)
 
-            # Use pooling to reduce the number of lines with quantile instead
-            # of maximum to prevent over saturation
-            sig = np.quantile(
-                np.reshape(self.signal[:self.length - self.length % 4096:32, :],
-                    (-1, 128, 2)), 0.95, axis=1)
+    def _finish_analysis(self):
+        """
+        Waits until the song is decoded, then computes the waveform and the
+        tempo map and stores the analysis in the cache.
+        """
+        try:
+            self.wait()
+            self.tempo_map = compute_tempo_map(self.signal[:, 0], self.bpm,
+                self.offset, self.parallel)
+            self.waveform = self.compute_waveform()
+            store_analysis(self.file, ANALYSIS_VERSION, self.get_analysis(),
+                self.waveform)
+        except Exception:
+            logging.exception(f'Could not analyze {self.file}')
+        finally:
+            self.analyzed.set()
+
+    def get_analysis(self) -> dict:
+        """
+        Returns the results of the analysis (as stored in the cache).
+        """
+        tempo_map = self.tempo_map
+        return {'bpm': float(self.bpm), 'offset': int(self.offset),
+                'length': int(self.length), 'key': self.key,
+                'tempo_map': tempo_map.tolist() if tempo_map is not None
+                else None}
 
-            time = np.linspace(0, width, sig.shape[0], endpoint=False)
+    def time_to_bar(self, time: float) -> float:
+        tempo_map = self.tempo_map
+        if tempo_map is None:
+            return (time - self.offset / AudioFile.SAMPLE_RATE) / (
+                    60 / self.bpm * 4)
+        i = _bar_index(tempo_map, time)
+        return float(i + (time - tempo_map[i]) / (tempo_map[i + 1] -
+                                                  tempo_map[i]))
 
-            # Zero-line
-            svg.add(svg.line((0, 50), (time[-1], 50), stroke=color))
+    def bar_to_time(self, bar: float) -> float:
+        tempo_map = self.tempo_map
+        if tempo_map is None:
+            return self.offset / AudioFile.SAMPLE_RATE + \
+                   bar * 60 / self.bpm * 4
+        i = int(np.clip(np.floor(bar), 0, tempo_map.shape[0] - 2))
+        return float(tempo_map[i] + (bar - i) * (tempo_map[i + 1] -
+                                                 tempo_map[i]))
+
+    def bpm_at(self, time: float) -> float:
+        """
+        Returns the local tempo at the time.
+        """
+        tempo_map = self.tempo_map
+        if tempo_map is None:
+            return self.bpm
+        i = _bar_index(tempo_map, time)
+        return float(60 * 4 / (tempo_map[i + 1] - tempo_map[i]))
 
-            # Signal line for both channels
-            svg.add(svg.polyline(points=[(time[0], 50)] + list(
-                zip(time, 50 - 50 * sig[:, 0])) + [(time[-1], 50)], fill=color))
-            svg.add(svg.polyline(points=[(time[0], 50)] + list(
-                zip(time, 50 + 50 * sig[:, 1])) + [(time[-1], 50)], fill=color))
-            svg.save()
+    def speed_at(self, time: float, bpm: float) -> float:
+        """
+        Returns the speedup at the time that matches the local tempo to the
+        given (global) BPM. Half and double tempo match as well, the speedup
+        closest to 1 is used.
+        """
+        speed = bpm / self.bpm_at(time)
+        return min([speed, speed / 2, speed * 2], key=lambda s: abs(1 - s))
 
-            return file.read()
+    def compute_waveform(self) -> bytes:
+        """
+        Computes the waveform as pyramid of `WAVEFORM_LEVELS` levels, whose
+        bins contain minimum and maximum (int8) as well as RMS (uint8) of the
+        mono signal. Returns the levels (of interleaved bins) as binary data.
+        """
+        bins = waveform_bins(self.length)
+        mono = np.mean(self.signal[:self.length], axis=1)
+        mono = np.pad(mono, (0, bins[0] * WAVEFORM_BIN - self.length),
+            mode='edge').reshape(bins[0], WAVEFORM_BIN)
+        low, high = np.min(mono, axis=1), np.max(mono, axis=1)
+        energy = np.mean(np.square(mono), axis=1)
+
+        levels = []
+        for i, num_bins in enumerate(bins):
+            if i > 0:
+                # Combine the bins of the finer level
+                pad = num_bins * WAVEFORM_FACTOR - low.shape[0]
+                low, high, energy = [np.pad(a, (0, pad), mode='edge').reshape(
+                    num_bins, WAVEFORM_FACTOR) for a in [low, high, energy]]
+                low, high = np.min(low, axis=1), np.max(high, axis=1)
+                energy = np.mean(energy, axis=1)
+            level = np.empty((num_bins, 3), dtype=np.uint8)
+            level[:, 0] = np.round(np.clip(low, -1, 1) * 127).astype(
+                np.int8).view(np.uint8)
+            level[:, 1] = np.round(np.clip(high, -1, 1) * 127).astype(
+                np.int8).view(np.uint8)
+            level[:, 2] = np.round(np.clip(np.sqrt(energy), 0, 1) * 255)
+            levels.append(level.tobytes())
+        return b''.join(levels)
@@ -0,0 +1,390 @@
+import threading
+from abc import ABC
+from typing import Optional, Type
+
+import numpy as np
+import pyrubberband
+import scipy.signal
+
+from autodj.backend.audio import AudioFile
+from autodj.backend.song import Song
+
+
+class Stretcher(ABC):
+    """
+    Implements a streaming time stretcher for a channel. The stretcher keeps
+    its state between blocks, so consecutive blocks are continuous.
+    """
+    ID = None
+
+    def __init__(self):
+        # Source position (in samples) the next block is expected to start at
+        self.expected = None
+
+    def reset(self, pos: float):
+        """
+        Restarts the stretcher at source position `pos` (in samples).
+        """
+        self.expected = pos
+
+    def process(self, src: AudioFile, time: float, length: int,
+            speed: float) -> np.ndarray:
+        """
+        Returns `length` stretched samples of `src` starting at `time` (in
+        seconds) where `speed` is the speedup of the song. If `time` does not
+        continue the previous block (e.g., after a seek) the stretcher is
+        restarted.
+        """
+        pos = time * AudioFile.SAMPLE_RATE
+        if self.expected is None or abs(pos - self.expected) > 1:
+            self.reset(pos)
+        out = self.stretch(src, length, speed)
+        self.expected += length * speed
+        return out
+
+    def stretch(self, src: AudioFile, length: int,
+            speed: float) -> np.ndarray:
+        raise NotImplementedError('Abstract base class')
+
+
+class WsolaStretcher(Stretcher):
+    """
+    Implements a Waveform Similarity Overlap-Add (WSOLA) time stretcher.
+
+    Frames of the source are overlap-added with a constant synthesis hop,
+    while the analysis hop depends on the speed. Each frame is shifted
+    (within a tolerance) such that it best matches the natural continuation
+    of the previous frame, which avoids phase cancellations.
+    """
+    ID = 'wsola'
+
+    FRAME_SIZE = 2048
+    HOP_SIZE = FRAME_SIZE // 2
+    # Maximum shift of a frame (in samples)
+    TOLERANCE = 256
+    # Length of the template used to find the best shift
+    TEMPLATE_SIZE = 512
+
+    # Periodic Hann window (sums up to exactly one at 50% overlap)
+    WINDOW = scipy.signal.get_window('hann', FRAME_SIZE)[:, None].astype(
+        np.float32)
+
+    def reset(self, pos: float):
+        super().reset(pos)
+        # Nominal source position of the next frame (set once the speed is
+        # known)
+        self.next_pos = None
+        # Overlap-add accumulator of the frames
+        self.acc = np.zeros((WsolaStretcher.FRAME_SIZE, 2), dtype=np.float32)
+        # Natural continuation of the previous frame (mono)
+        self.template = None
+        # Finished samples that were not returned yet
+        self.ready = np.zeros((0, 2), dtype=np.float32)
+        self.speed = None
+        # The first hop only contains the fade-in of the first frame
+        self.skip = WsolaStretcher.HOP_SIZE
+
+    def _next_frame(self, src: AudioFile, speed: float) -> np.ndarray:
+        """
+        Overlap-adds the next frame and returns the finished samples.
+        """
+        tol = WsolaStretcher.TOLERANCE
+        hop = WsolaStretcher.HOP_SIZE
+        p = int(round(self.next_pos))
+        region = src.stream(p - tol, WsolaStretcher.FRAME_SIZE + 2 * tol)
+
+        # Find the shift that best matches the natural continuation
+        shift = 0
+        if self.template is not None:
+            mono = region[:WsolaStretcher.TEMPLATE_SIZE + 2 * tol].sum(axis=1)
+            corr = np.correlate(mono, self.template, mode='valid')
+            shift = int(np.argmax(corr)) - tol
+
+        frame = region[tol + shift:tol + shift + WsolaStretcher.FRAME_SIZE]
+        self.template = frame[hop:hop + WsolaStretcher.TEMPLATE_SIZE].sum(
+            axis=1)
+
+        self.acc += frame * WsolaStretcher.WINDOW
+        out = self.acc[:hop].copy()
+        self.acc[:-hop] = self.acc[hop:]
+        self.acc[-hop:] = 0
+        self.next_pos += hop * speed
+        return out
+
+    def stretch(self, src: AudioFile, length: int,
+            speed: float) -> np.ndarray:
+        if self.next_pos is None:
+            # Start one hop early since its output is skipped
+            self.next_pos = self.expected - WsolaStretcher.HOP_SIZE * speed
+        else:
+            # Samples that are ready were computed with the previous speed,
+            # so the next frame is moved to keep the source position exact
+            self.next_pos += self.ready.shape[0] * (speed - self.speed)
+        self.speed = speed
+
+        blocks = [self.ready]
+        available = self.ready.shape[0]
+        while available < length:
+            block = self._next_frame(src, speed)
+            if self.skip > 0:
+                block = block[self.skip:]
+                self.skip = 0
+            blocks.append(block)
+            available += block.shape[0]
+        out = np.concatenate(blocks)
+        self.ready = out[length:]
+        return out[:length]
+
+
+class RubberbandStretcher(Stretcher):
+    """
+    Stretches every block separately using pyrubberband (i.e., the rubberband
+    command line tool). Transients between blocks are reduced by
+    cross-fading with the stretched signal following the previous block.
+    """
+    ID = 'rubberband'
+
+    TRANSIENT_SIZE = 1000
+
+    # Square-rooted equal power cross-fade
+    FADE_IN = np.repeat([np.sqrt(np.linspace(0, 1, TRANSIENT_SIZE))], 2,
+        axis=0).T
+    FADE_OUT = np.repeat([np.sqrt(np.linspace(1, 0, TRANSIENT_SIZE))], 2,
+        axis=0).T
+
+    def reset(self, pos: float):
+        super().reset(pos)
+        self.transient = None
+
+    def stretch(self, src: AudioFile, length: int,
+            speed: float) -> np.ndarray:
+        # Stream twice the signal needed in buffer (in case of heavy
+        # stretching)
+        # Then stretch the signal using pyrubberband
+        stretched = pyrubberband.time_stretch(
+            src.stream(int(self.expected), length * 2), AudioFile.SAMPLE_RATE,
+            speed, {'-R': '-R'}).astype(np.float32)
+
+        out = stretched[0:length]
+
+        # Reduce transients by cross-fading the future signal of the
+        # last block
+        if self.transient is not None:
+            out[:self.TRANSIENT_SIZE] *= self.FADE_IN
+            out[:self.TRANSIENT_SIZE] += self.FADE_OUT * self.transient
+
+        # Update transient for next block
+        self.transient = stretched[length:length + self.TRANSIENT_SIZE]
+        return out
+
+
+class _Generation:
+    """
+    Describes what the look-ahead renderer currently renders. A new
+    generation is started whenever the song, the global BPM or the position
+    changes unexpectedly. The speed follows the tempo map of the song within
+    a generation.
+    """
+
+    def __init__(self, song: Song, pos: float, bpm: float):
+        self.song = song
+        self.bpm = bpm
+        # Output samples consumed by the audio thread and the source
+        # position (in samples) of the next one (only written by it, as one
+        # tuple)
+        self.cursor = (0, pos)
+        # Output samples available in the ring (only written by the worker)
+        self.written = 0
+
+
+class LookaheadRenderer:
+    """
+    Stretches a song ahead of the playhead in a background thread and keeps
+    the result in a ring buffer, so the audio thread usually only copies
+    samples. If the renderer is not far enough ahead (e.g., right after a
+    seek or a BPM change), the block is stretched inline instead. Both
+    sources are cross-faded over one frame whenever the renderer switches
+    between them, since their frames are not aligned.
+
+    The worker determines the speed of every chunk from the tempo map, so a
+    changing local tempo does not invalidate the ring. The source position
+    of every sample in the ring is kept, since the audio thread would have
+    used other speeds (per block).
+
+    Without the background thread (not `threaded`), every block is stretched
+    inline, which makes the render time deterministic (e.g., for benchmarks).
+    """
+
+    # Number of samples stretched at once by the worker
+    CHUNK_SIZE = 4096
+    # Capacity of the ring buffer (in samples)
+    CAPACITY = AudioFile.SAMPLE_RATE * 8
+    # Time the worker sleeps if there is nothing to do (in seconds)
+    IDLE_TIME = 0.01
+    # Number of samples cross-faded when switching between the ring and
+    # inline stretching
+    FADE_SIZE = WsolaStretcher.FRAME_SIZE
+
+    def __init__(self, stretcher: Type[Stretcher] = WsolaStretcher,
+            threaded: bool = True):
+        self.ring = np.zeros((LookaheadRenderer.CAPACITY, 2),
+            dtype=np.float32)
+        # Source position (in samples) of every sample in the ring
+        self.positions = np.zeros(LookaheadRenderer.CAPACITY)
+        self.fallback = stretcher()
+        self.generation: Optional[_Generation] = None
+        # Whether the previous block was copied from the ring
+        self.from_ring = False
+        # Set to end the background thread
+        self.closed = threading.Event()
+        self.thread = None
+        if threaded:
+            self.thread = threading.Thread(target=self._run,
+                args=(stretcher,), daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stops rendering (e.g., if the channel is cleared).
+        """
+        self.generation = None
+        self.from_ring = False
+
+    def close(self):
+        """
+        Ends the background thread and waits until it has finished.
+        """
+        self.stop()
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def process(self, song: Song, time: float, length: int, bpm: float,
+            out: np.ndarray) -> float:
+        """
+        Writes `length` samples of `song` starting at `time` (in seconds),
+        stretched to the global `bpm` (see `Song.speed_at`), into `out`.
+        Returns the duration of the song that was stretched (in seconds).
+        """
+        fade = min(length, LookaheadRenderer.FADE_SIZE)
+        # Samples of the previous source that are faded out
+        previous = None
+
+        pos = time * AudioFile.SAMPLE_RATE
+        gen = self.generation
+        if gen is None or gen.song is not song or gen.bpm != bpm or abs(
+                gen.cursor[1] - pos) > 1:
+            if self.from_ring and gen.written >= gen.cursor[0] + fade:
+                # Fade out what was rendered before (before the worker
+                # overwrites it)
+                previous = self._read_ring(gen.cursor[0], fade)
+            # Invalidate the rendered samples and restart the worker
+            gen = _Generation(song, pos, bpm)
+            self.generation = gen
+            self.from_ring = False
+
+        read = gen.cursor[0]
+        # Keep a frame in reserve, so there is enough to fade out when the
+        # worker falls behind
+        if gen.written >= read + length + fade:
+            self._read_ring(read, length, out)
+            end = self.positions[(read + length) % LookaheadRenderer.CAPACITY]
+            duration = (end - pos) / AudioFile.SAMPLE_RATE
+            if not self.from_ring:
+                # Fade in the ring
+                previous = self.fallback.process(song, time, fade,
+                    song.speed_at(time, bpm))
+                self._crossfade(previous, out[:fade], out[:fade])
+            self.from_ring = True
+        else:
+            # The worker is behind, so we stretch the block ourselves
+            if self.from_ring and gen.written >= read + fade:
+                previous = self._read_ring(read, fade)
+            speed = song.speed_at(time, bpm)
+            out[:] = self.fallback.process(song, time, length, speed)
+            if previous is not None:
+                self._crossfade(previous, out[:fade], out[:fade])
+            duration = length / AudioFile.SAMPLE_RATE * speed
+            self.from_ring = False
+
+        gen.cursor = (read + length, pos + duration * AudioFile.SAMPLE_RATE)
+        return duration
+
+    def _read_ring(self, read: int, length: int,
+            out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Copies `length` samples starting at output sample `read` from the
+        ring.
+        """
+        if out is None:
+            out = np.empty((length, 2), dtype=np.float32)
+        start = read % LookaheadRenderer.CAPACITY
+        end = start + length
+        if end <= LookaheadRenderer.CAPACITY:
+            out[:] = self.ring[start:end]
+        else:
+            split = LookaheadRenderer.CAPACITY - start
+            out[:split] = self.ring[start:]
+            out[split:] = self.ring[:end - LookaheadRenderer.CAPACITY]
+        return out
+
+    @staticmethod
+    def _crossfade(a: np.ndarray, b: np.ndarray, out: np.ndarray):
+        """
+        Linearly cross-fades from `a` to `b` (both stretched from the same
+        source, so their levels add up).
+        """
+        fade_in = ((np.arange(a.shape[0]) + 0.5) / a.shape[0]).astype(
+            np.float32)[:, None]
+        np.multiply(b, fade_in, out=out)
+        out += a * (1 - fade_in)
+
+    def _run(self, stretcher: Type[Stretcher]):
+        """
+        Stretches the current generation into the ring buffer until the
+        renderer is closed.
+        """
+        rendering = None
+        worker = stretcher()
+        # Source position (in samples) of the next chunk
+        pos = 0.0
+        ramp = np.arange(LookaheadRenderer.CHUNK_SIZE, dtype=np.float64)
+        while not self.closed.is_set():
+            gen = self.generation
+            if gen is None:
+                self.closed.wait(LookaheadRenderer.IDLE_TIME)
+                continue
+            read, read_pos = gen.cursor
+            if gen is not rendering or gen.written < read:
+                # Start rendering where the audio thread currently is
+                rendering = gen
+                gen.written = read
+                pos = read_pos
+
+            length = LookaheadRenderer.CHUNK_SIZE
+            speed = gen.song.speed_at(pos / AudioFile.SAMPLE_RATE, gen.bpm)
+            src_end = pos + length * speed + WsolaStretcher.FRAME_SIZE
+            if gen.written + length - read > LookaheadRenderer.CAPACITY \
+                    or (not gen.song.is_decoded and src_end > gen.song.length):
+                # The ring is full or the song is not decoded far enough
+                self.closed.wait(LookaheadRenderer.IDLE_TIME)
+                continue
+
+            chunk = worker.process(gen.song, pos / AudioFile.SAMPLE_RATE,
+                length, speed)
+            positions = pos + ramp * speed
+            start = gen.written % LookaheadRenderer.CAPACITY
+            end = start + length
+            if end <= LookaheadRenderer.CAPACITY:
+                self.ring[start:end] = chunk
+                self.positions[start:end] = positions
+            else:
+                split = LookaheadRenderer.CAPACITY - start
+                self.ring[start:] = chunk[:split]
+                self.ring[:end - LookaheadRenderer.CAPACITY] = chunk[split:]
+                self.positions[start:] = positions[:split]
+                self.positions[:end - LookaheadRenderer.CAPACITY] = \
+                    positions[split:]
+            pos += length * speed
+            gen.written += length
@@ -0,0 +1,127 @@
+# transitions: Loads, validates and watches the transitions.
+
+import glob
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Any, Optional, Tuple
+
+from autodj.backend.channel import CompiledTransition, compile_transition
+from autodj.backend.watch import create_watcher
+
+TRANSITION_DIR = 'data/transitions'
+
+
+def transition_id(file: str) -> str:
+    """
+    Returns the ID of a transition, i.e., its file name without extension.
+    """
+    return os.path.splitext(os.path.basename(file))[0]
+
+
+def load_transition(file: str, effects: Dict[str, Any]) -> \
+        Tuple[dict, CompiledTransition]:
+    """
+    Loads and compiles a transition file. Returns its definition (with `id`,
+    `name` and `fx`) and the compiled transition. Raises a `ValueError` if
+    the file is invalid.
+    """
+    with open(file) as j:
+        js = json.load(j)
+    if not isinstance(js, dict) or 'fx' not in js:
+        raise ValueError('The transition has no effects')
+    compiled = compile_transition(js['fx'], effects)
+    return {'id': transition_id(file), 'name': str(js.get('name',
+        transition_id(file))), 'fx': js['fx']}, compiled
+
+
+class TransitionRegistry:
+    """
+    Holds all valid transitions of the directory compiled by their ID. The
+    directory is watched, so added, changed and removed transitions are
+    available immediately and increase the `version`. Invalid files are
+    logged and skipped.
+    """
+
+    def __init__(self, effects: Dict[str, Any],
+            directory: str = TRANSITION_DIR):
+        self.effects = effects
+        self.directory = directory
+        # Increased by the watcher thread after the transitions changed
+        self.version = 0
+        self.lock = threading.Lock()
+        self.definitions: Dict[str, dict] = {}
+        self.compiled: Dict[str, CompiledTransition] = {}
+        self._load_all()
+
+    def _files(self) -> List[str]:
+        return glob.glob(os.path.join(self.directory, '*.json'))
+
+    def _load(self, file: str):
+        """
+        (Re)loads a transition file, removing the transition if it is
+        invalid.
+        """
+        tid = transition_id(file)
+        try:
+            definition, compiled = load_transition(file, self.effects)
+        except (OSError, ValueError) as e:
+            logging.error(f'Invalid transition {file}: {e}')
+            self._remove(tid)
+            return
+        with self.lock:
+            self.definitions[tid] = definition
+            self.compiled[tid] = compiled
+
+    def _remove(self, tid: str):
+        with self.lock:
+            self.definitions.pop(tid, None)
+            self.compiled.pop(tid, None)
+
+    def _load_all(self):
+        files = self._files()
+        ids = set(transition_id(f) for f in files)
+        for tid in set(self.compiled) - ids:
+            self._remove(tid)
+        for file in files:
+            self._load(file)
+        logging.info(f'Loaded {len(self.compiled)} transitions')
+
+    def _changed(self, file: Optional[str], exists: bool):
+        if file is None:
+            self._load_all()
+        elif file.endswith('.json'):
+            if exists:
+                logging.info(f'Reloading transition {file}')
+                self._load(file)
+            else:
+                self._remove(transition_id(file))
+        else:
+            return
+        with self.lock:
+            self.version += 1
+
+    def watch(self):
+        """
+        Watches the directory in a background thread.
+        """
+        watcher = create_watcher(self.directory, self._files)
+        threading.Thread(target=watcher.run, args=(self._changed,),
+            daemon=True).start()
+
+    def get(self, tid: str) -> CompiledTransition:
+        """
+        Returns the compiled transition. Raises a `KeyError` if there is no
+        valid transition with the ID.
+        """
+        with self.lock:
+            return self.compiled[tid]
+
+    def list(self) -> List[dict]:
+        """
+        Returns the definitions of all transitions (sorted by name).
+        """
+        with self.lock:
+            return sorted(self.definitions.values(),
+                key=lambda d: d['name'].lower())
@@ -0,0 +1,129 @@
+# watch: Watches a directory for added, changed and removed files.
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Called with the file and whether it exists (i.e., was added or changed)
+# or `None` if all files must be checked again (e.g., after an overflow)
+ChangeCallback = Callable[[Optional[str], bool], None]
+
+# inotify events (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+# Header of an inotify event (watch descriptor, mask, cookie, name length)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Receives change notifications from the Linux kernel via inotify. Raises
+    an `OSError` if inotify is not available.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | \
+               IN_DELETE_SELF | IN_MOVE_SELF
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'Can not watch {directory}')
+
+    def run(self, callback: ChangeCallback):
+        """
+        Reports changes until the directory is removed.
+        """
+        try:
+            while True:
+                data = os.read(self.fd, 64 * 1024)
+                pos = 0
+                while pos < len(data):
+                    _, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+                    pos += EVENT_HEADER.size
+                    name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+                    pos += length
+
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                        logging.warning(f'{self.directory} is gone')
+                        return
+                    if mask & IN_Q_OVERFLOW:
+                        callback(None, False)
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        callback(os.path.join(self.directory, name), True)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        callback(os.path.join(self.directory, name), False)
+        finally:
+            os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Detects changes by comparing modification time and size of the files
+    every `interval` seconds.
+    """
+
+    def __init__(self, list_files: Callable[[], List[str]],
+            interval: float = 5.0):
+        self.list_files = list_files
+        self.interval = interval
+        # Last reported and last seen state of the files
+        self.reported = self._stat_all()
+        self.seen = dict(self.reported)
+
+    def _stat_all(self) -> Dict[str, Tuple[int, int]]:
+        stats = {}
+        for file in self.list_files():
+            try:
+                stat = os.stat(file)
+                stats[file] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                pass
+        return stats
+
+    def run(self, callback: ChangeCallback):
+        """
+        Reports changes forever. Changed files are only reported once they
+        stayed the same for one interval (e.g., after they were copied).
+        """
+        while True:
+            time.sleep(self.interval)
+            stats = self._stat_all()
+            for file in self.reported.keys() - stats.keys():
+                del self.reported[file]
+                callback(file, False)
+            for file, stat in stats.items():
+                if stat == self.seen.get(file) and \
+                        stat != self.reported.get(file):
+                    self.reported[file] = stat
+                    callback(file, True)
+            self.seen = stats
+
+
+def create_watcher(directory: str, list_files: Callable[[], List[str]]):
+    """
+    Creates a watcher for the directory, using inotify if possible and
+    polling `list_files` otherwise.
+    """
+    try:
+        return InotifyWatcher(directory)
+    except (OSError, AttributeError, TypeError) as e:
+        logging.info(f'Polling {directory} for changes ({e})')
+        return PollingWatcher(list_files)
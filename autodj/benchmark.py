@@ -0,0 +1,306 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+import scipy.fft
+import scipy.interpolate
+import scipy.ndimage
+import scipy.signal
+
+from autodj.backend.analysis import analyze_song, _to_reasonable_bpm
+from autodj.backend.audio import AudioFile
+from autodj.backend.channel import compile_transition
+from autodj.backend.metrics import RenderMetrics
+from autodj.backend.mixer import Mixer
+from autodj.backend.song import Song
+from autodj.backend.stretch import Stretcher
+
+# Number of blocks rendered before measuring (e.g., to warm up caches)
+WARMUP_BLOCKS = 8
+
+# Tempos of the synthetic songs analyzed by the analysis benchmark
+ANALYSIS_BPMS = [96.0, 110.0, 124.0, 128.0, 140.0, 174.0]
+# Number of times every song is analyzed
+ANALYSIS_RUNS = 3
+
+
+def get_all_stretchers() -> Dict[str, type]:
+    """
+    Get all time stretchers defined in the `stretch` module with a valid ID
+    """
+    return dict([(s.ID, s) for s in Stretcher.__subclasses__() if
+                 s.ID is not None])
+
+
+def load_songs(files: List[str], duration: float) -> Tuple[Song, Song]:
+    """
+    Loads the two songs that are mixed by the benchmark. Without files, two
+    synthetic songs with slightly different tempos are used, so both
+    channels are stretched.
+    """
+    if files:
+        songs = [Song(file) for file in files]
+        for song in songs:
+            song.wait()
+        return songs[0], songs[-1]
+    return (Song.synthesize(bpm=124.0, length=duration + 10, seed=1),
+            Song.synthesize(bpm=128.0, length=duration + 10, seed=2))
+
+
+def run_scenario(stretcher: type, trans: dict, songs: Tuple[Song, Song],
+        block_size: int, blocks: int, lookahead: bool, channels: int,
+        threads: int) -> dict:
+    """
+    Renders a transition from the first to the second song over `blocks`
+    blocks without an audio stream and returns the measured throughput and
+    block latencies (in milliseconds). Further channels layer the songs
+    with the same transition.
+    """
+    mixer = Mixer(stretcher, block_size=block_size, stream=False,
+        lookahead=lookahead, num_channels=channels, threads=threads)
+    mixer.global_bpm = 126
+    duration = (WARMUP_BLOCKS + blocks) * block_size / AudioFile.SAMPLE_RATE
+
+    try:
+        compiled = compile_transition(trans['fx'], mixer.all_effects)
+        for i, channel in enumerate(mixer.channels):
+            channel.load(songs[i % 2])
+            channel.transition = compiled.automate(0, duration,
+                inp=i % 2 == 1)
+            channel.play(0)
+
+        for _ in range(WARMUP_BLOCKS):
+            mixer.produce()
+        mixer.metrics = RenderMetrics(history=blocks)
+
+        start = time.perf_counter()
+        for _ in range(blocks):
+            mixer.produce()
+        elapsed = time.perf_counter() - start
+    finally:
+        # Otherwise the workers keep stretching during the next scenarios
+        mixer.close()
+
+    summary = mixer.metrics.summary()
+    audio_time = blocks * block_size / AudioFile.SAMPLE_RATE
+    return {'blocks_per_sec': blocks / elapsed,
+            'realtime_factor': audio_time / elapsed,
+            'stages': dict((name, {'p50': stage['p50'], 'p99': stage['p99']})
+                           for name, stage in summary['stages'].items())}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Returns the stages whose p50 or p99 latency regressed by more than
+    `tolerance` (relative) with respect to the baseline.
+    """
+    regressions = []
+    for scenario, result in results.items():
+        if scenario not in baseline:
+            continue
+        for name, stage in result['stages'].items():
+            old = baseline[scenario]['stages'].get(name)
+            if old is None:
+                continue
+            for p in ['p50', 'p99']:
+                if stage[p] > old[p] * (1 + tolerance):
+                    regressions.append(f'{scenario} {name} {p}: '
+                                       f'{old[p]:.3f} -> {stage[p]:.3f} ms')
+    return regressions
+
+
+def add_pw_functions(x1: List[float], y1: List[float], x2: List[float],
+        y2: List[float]) -> Tuple[List[float], List[float]]:
+    """
+    Adds two piecewise linear functions.
+    """
+    a = scipy.interpolate.interp1d(x1, y1, fill_value=(0, 0),
+        bounds_error=False)
+    if x2.shape[0] > 0:
+        b = scipy.interpolate.interp1d(x2, y2, fill_value=(0, 0),
+            bounds_error=False)
+    else:
+        b = lambda x: 0
+    abx = np.unique(np.concatenate((x1, x2)))
+    ab = a(abx) + b(abx)
+    ab = scipy.interpolate.interp1d(abx, ab, fill_value=(0, 0),
+        bounds_error=False)
+    return np.asarray(abx), np.asarray(ab(abx))
+
+
+def normalize(x):
+    """
+    Subtracts the trend based on a 2nd degree polynomial and normalizes.
+    """
+    p = np.arange(x.shape[0])
+    y = (x - np.polyval(np.polyfit(p, x, 2), p))
+    l = np.linalg.norm(y, 2)
+    if l == 0:
+        return y
+    else:
+        return y / l
+
+
+def reference_analyze_song(src: AudioFile) -> Tuple[float, float]:
+    """
+    The original (unvectorized) implementation of `analyze_song`, which the
+    analysis benchmark compares against.
+    """
+    src.wait(AudioFile.SAMPLE_RATE * 60)
+    inp = src.stream(0, AudioFile.SAMPLE_RATE * 60)[:, 0]
+    b, a = scipy.signal.butter(2, 0.01)
+    inp = scipy.signal.lfilter(b, a, inp)
+    f, t, Sxx = scipy.signal.spectrogram(inp, AudioFile.SAMPLE_RATE)
+
+    Sxx_flat = np.sum(Sxx, axis=0)
+    corr = scipy.signal.correlate(Sxx_flat, Sxx_flat, mode='full')
+    corr = scipy.ndimage.gaussian_filter(corr, 10)
+    corr = corr[corr.shape[0] // 2:]
+    x = np.arange(corr.shape[0])
+    corr -= np.polyval(np.polyfit(x, corr, 3), x)
+    f = np.abs(scipy.fft.fft(corr))
+    f = f[:f.shape[0] // 2]
+    abx = np.empty(0)
+    aby = np.empty(0)
+    l = f.shape[0]
+    d = 1
+
+    while l >= 2 and d <= 32:
+        abx, aby = add_pw_functions(np.arange(f.shape[0]) / d, f, abx, aby)
+        l /= 2
+        d += 1
+    ind = (abx >= 30) & (abx <= 180)
+    abx = abx[ind]
+    aby = aby[ind]
+    aby -= np.polyval(np.polyfit(abx, aby, 2), abx)
+    bpms = abx[np.argmax(aby)]
+    bpm = _to_reasonable_bpm(bpms)[-1]
+
+    Sxx_bass = Sxx[0, :]
+    bar = np.abs(t - (60 / bpm) * 4).argmin()
+    acc = np.zeros_like(Sxx_bass[0:bar])
+    for i in range(0, 2048):
+        off = np.abs(t - (60 / bpm) * i * 4).argmin()
+        if off + bar >= Sxx_bass.shape[0]:
+            break
+        acc += normalize(Sxx_bass[off:off + bar])
+    offset = int((t[acc.argmax()] % (60 / bpm)) * AudioFile.SAMPLE_RATE)
+
+    return bpm, offset
+
+
+def run_analysis(files: List[str]) -> List[str]:
+    """
+    Analyzes synthetic songs (and the given files) with `analyze_song` and
+    the reference implementation, prints the timings and returns the songs
+    whose results differ.
+    """
+    songs = [Song.synthesize(bpm=bpm, length=60, seed=i) for i, bpm in
+             enumerate(ANALYSIS_BPMS)]
+    for file in files or []:
+        song = Song(file)
+        song.wait()
+        songs.append(song)
+
+    mismatches = []
+    for song in songs:
+        results = []
+        for func in [reference_analyze_song, analyze_song]:
+            start = time.perf_counter()
+            for _ in range(ANALYSIS_RUNS):
+                result = func(song)
+            elapsed = (time.perf_counter() - start) / ANALYSIS_RUNS
+            results.append((result, elapsed))
+        (ref, ref_time), (new, new_time) = results
+        print(f'{os.path.basename(song.file)}: BPM {new[0]:.2f}, offset '
+              f'{new[1]}, {new_time * 1000:.1f} ms (reference '
+              f'{ref_time * 1000:.1f} ms, {ref_time / new_time:.1f}x)')
+        if not np.isclose(ref[0], new[0]) or ref[1] != new[1]:
+            mismatches.append(f'{song.file}: BPM {ref[0]} -> {new[0]}, '
+                              f'offset {ref[1]} -> {new[1]}')
+    return mismatches
+
+
+def print_result(scenario: str, result: dict):
+    print(f'{scenario}: {result["blocks_per_sec"]:.1f} blocks/s, '
+          f'{result["realtime_factor"]:.1f}x real-time')
+    for name, stage in sorted(result['stages'].items()):
+        print(f'    {name:<12} p50 {stage["p50"]:8.3f} ms   '
+              f'p99 {stage["p99"]:8.3f} ms')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the render path of the AutoDJ mixer without '
+                    'a sound card')
+    parser.add_argument('--blocks', type=int, default=128,
+        help='number of blocks measured per scenario')
+    parser.add_argument('--block-size', type=int, default=Mixer.BUFFER_SIZE,
+        help='number of samples rendered per block')
+    parser.add_argument('--stretcher', action='append',
+        choices=sorted(get_all_stretchers()),
+        help='stretch backend to benchmark (default: all)')
+    parser.add_argument('--transitions', default='data/transitions/*.json',
+        help='pattern of the transitions to benchmark')
+    parser.add_argument('--songs', nargs=2, metavar='FILE',
+        help='songs to mix instead of synthetic ones')
+    parser.add_argument('--lookahead', action='store_true',
+        help='stretch in the background instead of inline')
+    parser.add_argument('--channels', type=int, default=2,
+        help='number of channels (decks) playing')
+    parser.add_argument('--threads', type=int,
+        help='number of render threads (default: one per channel)')
+    parser.add_argument('--analysis', action='store_true',
+        help='benchmark the song analysis against the reference '
+             'implementation instead')
+    parser.add_argument('--save', metavar='FILE',
+        help='save the results as baseline')
+    parser.add_argument('--compare', metavar='FILE',
+        help='compare the results with a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='relative slowdown that is reported as regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING,
+        format="(%(asctime)s) [%(levelname)s] %(message)s", datefmt='%H:%M:%S')
+
+    if args.analysis:
+        mismatches = run_analysis(args.songs)
+        for mismatch in mismatches:
+            print(f'Mismatch: {mismatch}')
+        sys.exit(1 if mismatches else 0)
+
+    stretchers = get_all_stretchers()
+    names = args.stretcher or sorted(stretchers)
+    duration = (WARMUP_BLOCKS + args.blocks) * args.block_size / \
+               AudioFile.SAMPLE_RATE
+    songs = load_songs(args.songs, duration)
+
+    results = {}
+    for file in sorted(glob.glob(args.transitions)):
+        with open(file) as j:
+            trans = json.load(j)
+        for name in names:
+            scenario = f'{name}/{os.path.basename(file)}'
+            results[scenario] = run_scenario(stretchers[name], trans, songs,
+                args.block_size, args.blocks, args.lookahead, args.channels,
+                args.threads)
+            print_result(scenario, results[scenario])
+
+    if args.save:
+        with open(args.save, 'w') as j:
+            json.dump(results, j, indent=2)
+
+    if args.compare:
+        with open(args.compare) as j:
+            regressions = compare(results, json.load(j), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
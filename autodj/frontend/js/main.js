@@ -1,9 +1,9 @@
-import {Channel} from './modules/channel.js';
+import {Channel, MAIN_DECKS} from './modules/channel.js';
+import {formatTime} from './modules/util.js';
 
 window.channels = [new Channel(0), new Channel(1)];
 
 let lastStatus = null;
-let transitions = {};
 
 /**
  * Updates the general UI after a status update.
@@ -12,78 +12,208 @@ function updateUI() {
     $('#queue').prop('disabled',
         lastStatus.actions.queue === 'INVALID' || !queue(true));
     $('#cancel').prop('disabled', lastStatus.actions.cancel === 'INVALID');
+    for (let c of channels.slice(MAIN_DECKS)) {
+        let actions = lastStatus.layers[c.id - MAIN_DECKS];
+        $(`#layer-queue-${c.id}`).prop('disabled', !queueLayer(c, true))
+            .text(actions.queue === 'FADE_OUT' ? 'Fade out' : 'Fade in');
+        $(`#layer-cancel-${c.id}`).prop('disabled',
+            actions.cancel === 'INVALID');
+    }
     if ($('#bpm')[0] !== document.activeElement) {
         $('#bpm').val(lastStatus.bpm);
     }
 }
 
+/**
+ * Merges a status update pushed by the server into the last status.
+ */
+function applyStatus(delta) {
+    if (lastStatus === null || Array.isArray(delta.channels)) {
+        lastStatus = Object.assign(lastStatus || {}, delta);
+        return;
+    }
+    for (let key in delta) {
+        if (key === 'channels') {
+            for (let i in delta.channels) {
+                Object.assign(lastStatus.channels[i], delta.channels[i]);
+            }
+        } else {
+            lastStatus[key] = delta[key];
+        }
+    }
+}
+
+/**
+ * Creates the panels of the layer decks (once the number of decks is known).
+ */
+function createLayers() {
+    let template = $('#layer-template')[0];
+    for (let i = channels.length; i < lastStatus.channels.length; i++) {
+        let layer = template.content.cloneNode(true);
+        $(layer).find('[id$="-N"]').each(function () {
+            this.id = this.id.replace(/-N$/, `-${i}`);
+        });
+        $('.layers').append(layer);
+        let c = new Channel(i);
+        channels.push(c);
+        $(`#lock-${i}`).on('click', () => {
+            c.scrollLock = true;
+        });
+        $(`#layer-queue-${i}`).on('click', () => {
+            queueLayer(c, false);
+        });
+        $(`#layer-cancel-${i}`).on('click', () => {
+            sck.emit('mixer_cancel_layer', i);
+        });
+    }
+    $('th.layer-load').show();
+    loadTransitions();
+    // Add the buttons to load songs into the layers
+    searchSongs(false, true);
+}
+
 /**
  * Queues the transition. If `dry`, nothing is actually queued but
  * instead returns whether queueing is possible.
  */
 function queue(dry) {
-    let sel_A = null, sel_B = null;
-    if (channels[0].region !== null) {
-        sel_A = [channels[0].region[0] - 1000000 / 25,
-            channels[0].region[1] - 1000000 / 25];
-    }
-    if (channels[1].region !== null) {
-        sel_B = [channels[1].region[0] - 1000000 / 25,
-            channels[1].region[1] - 1000000 / 25];
-    }
-    if ((lastStatus.actions.queue === 'INIT_A' && sel_A !== null) ||
-        (lastStatus.actions.queue !== 'INIT_A' && sel_A !== null && sel_B !==
-            null)) {
+    let main = channels.slice(0, MAIN_DECKS);
+    let transitions = main.map(c => $(`#song-transition-${c.id}`).val());
+    let selections = main.map(c => c.region);
+    // In init, only the first deck fades in
+    let required = lastStatus.actions.queue.startsWith('INIT_') ?
+        selections.slice(0, 1) : selections;
+    if (required.every(s => s !== null)) {
         if (dry) {
             return true;
         }
-        sck.emit('mixer_queue', transitions[$('#song-transition-0').val()],
-            transitions[$('#song-transition-1').val()], sel_A, sel_B);
-        channels[0].clearSelection();
-        channels[1].clearSelection();
+        sck.emit('mixer_queue', transitions, selections);
+        main.forEach(c => c.clearSelection());
     }
     if (dry) {
         return false;
     }
 }
 
-window.onload = (e) => {
-    window.sck = io();
+/**
+ * Fades the layer in, starting its selection with the selection of the
+ * master deck, or fades it out over its selection. If `dry`, nothing is
+ * actually queued but instead returns whether queueing is possible.
+ */
+function queueLayer(layer, dry) {
+    let action = lastStatus.layers[layer.id - MAIN_DECKS].queue;
+    let master = channels[lastStatus.master.charCodeAt(0) - 65];
+    let fadeIn = action === 'FADE_IN';
+    if (action === 'INVALID' || layer.region === null ||
+        (fadeIn && master.region === null)) {
+        return false;
+    }
+    if (dry) {
+        return true;
+    }
+    sck.emit('mixer_queue_layer', layer.id,
+        $(`#song-transition-${layer.id}`).val(), layer.region,
+        fadeIn ? master.region : null);
+    layer.clearSelection();
+    if (fadeIn) {
+        master.clearSelection();
+    }
+    return true;
+}
 
-    sck.on('connect', () => {
-        console.log('Connected.');
-    });
-    sck.on('disconnect', () => {
-        console.log('Disconnected.');
+/**
+ * Fills the transition selections with the transitions of the server (by
+ * their ID), keeping the selected ones if they still exist.
+ */
+function loadTransitions() {
+    sck.emit('transition_list', (trans) => {
+        $('select.transition').each(function () {
+            let selected = $(this).val();
+            $(this).empty();
+            trans.forEach(t => {
+                $(this).append(new Option(t.name, t.id));
+            });
+            if (trans.some(t => t.id === selected)) {
+                $(this).val(selected);
+            }
+        });
     });
+}
 
-    $('#queue').on('click', () => {
-        queue(false);
-    });
-    $('#cancel').on('click', () => {
-        sck.emit('mixer_cancel');
+/**
+ * Returns the row of the song list showing the given file.
+ */
+function songRow(file) {
+    return $('#songs tr:not(.header)').filter(function () {
+        return $(this).data('file') === file;
     });
+}
 
-    // Get a status update twice a second
-    window.setInterval((e) => {
-        if (!sck.connected) {
+// Number of songs requested per page of the search
+const SEARCH_PAGE = 100;
+// Milliseconds after which an unanswered search is given up
+const SEARCH_TIMEOUT = 10000;
+
+// Current search (the query, the sort order, the number of shown songs and
+// the version of the library they are from, and the ID of the last request)
+let search = {
+    query: '', sort: 'title', descending: false, shown: 0, total: 0,
+    loading: false, version: null, id: 0
+};
+
+/**
+ * Searches the songs (including their BPM, key and length) on the server.
+ * Without `more` the list is replaced, otherwise the next page is appended.
+ * If `refresh`, all shown songs are reloaded (page by page) and the list
+ * keeps its scroll position.
+ */
+function searchSongs(more = false, refresh = false) {
+    if ((more || refresh) && search.loading) {
+        return;
+    }
+    search.loading = true;
+    let id = ++search.id;
+    let offset = more ? search.shown : 0;
+    let count = refresh ? Math.max(search.shown, SEARCH_PAGE) : SEARCH_PAGE;
+    let query = search.query;
+    let songs = [];
+    let timeout = null;
+    let request = () => {
+        // The server does not answer if the search failed
+        timeout = setTimeout(() => {
+            if (id === search.id) {
+                console.log('Search timed out.');
+                search.id++;
+                search.loading = false;
+            }
+        }, SEARCH_TIMEOUT);
+        sck.emit('song_search', query, search.sort, search.descending,
+            offset + songs.length, SEARCH_PAGE, receive);
+    };
+    let receive = (result) => {
+        clearTimeout(timeout);
+        if (id !== search.id) {
+            // Outdated
             return;
         }
-        sck.emit('mixer_status', (status) => {
-            lastStatus = status;
-            for (let i in status.channels) {
-                channels[i].update(status);
-            }
-            updateUI();
-        });
-    }, 500);
-
-    // Get all available songs
-    sck.emit('song_list', (songs) => {
+        songs.push(...result.songs);
+        if (songs.length < count && result.songs.length === SEARCH_PAGE) {
+            request();
+            return;
+        }
+        search.loading = false;
+        if (!more) {
+            // Appended pages may be newer, then the next progress refreshes
+            search.version = result.version;
+        }
         let table = $('#songs')[0];
-        songs.sort((a, b) => {
-            return a.title.localeCompare(b.title);
-        });
+        let list = $('.song-list')[0];
+        let scroll = list.scrollTop;
+        if (!more) {
+            $('#songs tr:not(.header)').remove();
+        }
+        search.shown = offset + songs.length;
+        search.total = result.total;
         songs.forEach(song => {
             let row = table.insertRow();
             $(row).data('file', song.file);
@@ -91,21 +221,97 @@ window.onload = (e) => {
             artist.innerText = song.artist;
             let title = row.insertCell(1);
             title.innerText = song.title;
+            let bpm = row.insertCell(2);
+            bpm.innerText = song.bpm !== null ? song.bpm : '';
+            let key = row.insertCell(3);
+            key.innerText = song.key !== null ? song.key : '';
+            let length = row.insertCell(4);
+            length.innerText = song.length !== null ?
+                formatTime(song.length) : '';
             $(row).on('click', () => {
                 sck.emit('mixer_load', $(row).data('file'));
             });
+            // Buttons to load the song into a layer instead
+            if (channels.length > MAIN_DECKS) {
+                let layers = row.insertCell(5);
+                layers.className = 'layer-load';
+                for (let c of channels.slice(MAIN_DECKS)) {
+                    $('<button>').text(String.fromCharCode(65 + c.id))
+                        .on('click', (e) => {
+                            e.stopPropagation();
+                            sck.emit('mixer_load', song.file, c.id);
+                        }).appendTo(layers);
+                }
+            }
         });
+        if (refresh) {
+            list.scrollTop = scroll;
+        }
+    };
+    request();
+}
+
+window.onload = (e) => {
+    window.sck = io();
+
+    sck.on('connect', () => {
+        console.log('Connected.');
+    });
+    sck.on('disconnect', () => {
+        console.log('Disconnected.');
     });
 
-    // Get all available transitions
-    sck.emit('transition_list', (trans) => {
-        trans.forEach(t => {
-            $('select').append(new Option(t.name, t.file));
-            transitions[t.file] = t.fx;
-        });
-        console.log(transitions);
+    // Mark songs while they are loading
+    sck.on('song_loading', (song) => {
+        songRow(song.file).addClass('loading');
+    });
+    sck.on('song_ready', (song) => {
+        songRow(song.file).removeClass('loading');
+    });
+    // Show the waveform and the bar grid once the song is analyzed
+    sck.on('song_analyzed', (song) => {
+        for (let c of channels) {
+            if (c.channel !== null && c.channel.file === song.file) {
+                c.setup(true);
+            }
+        }
+    });
+
+    $('#queue').on('click', () => {
+        queue(false);
+    });
+    $('#cancel').on('click', () => {
+        sck.emit('mixer_cancel');
     });
 
+    // The server pushes the full status on connect and only the changes
+    // after every block
+    sck.on('mixer_status', (delta) => {
+        applyStatus(delta);
+        if (channels.length < lastStatus.channels.length) {
+            createLayers();
+        }
+        for (let c of channels) {
+            c.update(lastStatus);
+        }
+        updateUI();
+    });
+
+    // Search the songs and update them whenever the library changes
+    searchSongs();
+    sck.on('library_progress', (progress) => {
+        $('#song-query').attr('placeholder', progress.running ?
+            `Search a song... (indexing ${progress.done}/${progress.total})` :
+            'Search a song...');
+        if (progress.version !== search.version) {
+            searchSongs(false, true);
+        }
+    });
+
+    // Get all available transitions and reload them whenever they change
+    loadTransitions();
+    sck.on('transitions_changed', loadTransitions);
+
     // Update the cursor more frequently than the status update by extrapolating
     window.setInterval((e) => {
         for (let c of channels) {
@@ -116,12 +322,28 @@ window.onload = (e) => {
         }
     }, 100);
 
-    // Update search bar
+    // Search on the server while typing
     $('#song-query').on('keyup', function () {
-        let value = $(this).val().toLowerCase();
-        $('#songs tr:not(.header)').filter(function () {
-            $(this).toggle($(this).text().toLowerCase().indexOf(value) > -1);
-        });
+        if ($(this).val() !== search.query) {
+            search.query = $(this).val();
+            searchSongs();
+        }
+    });
+
+    // Sort by the clicked column (again to reverse)
+    $('#songs .header th[data-sort]').on('click', function () {
+        let sort = $(this).data('sort');
+        search.descending = sort === search.sort && !search.descending;
+        search.sort = sort;
+        searchSongs();
+    });
+
+    // Load the next page when scrolled to the end
+    $('.song-list').on('scroll', function () {
+        if (this.scrollTop + this.clientHeight >= this.scrollHeight - 50 &&
+            search.shown < search.total) {
+            searchSongs(true);
+        }
     });
 
     $('#bpm').on('change', function () {
@@ -1,6 +1,11 @@
-import {formatTime, getBlob} from './util.js';
+import {formatTime} from './util.js';
+import {drawWaveform} from './waveform.js';
 
 const OFF = 1_000_000;
+const SVG_NS = 'http://www.w3.org/2000/svg';
+
+// Number of main decks (A and B), the further decks are layers
+export const MAIN_DECKS = 2;
 
 export class Channel {
     /**
@@ -26,6 +31,7 @@ export class Channel {
     }
 
     constructor(id) {
+        // Index of the deck
         this.id = id;
         this.scrollLock = false;
         this.ignoreScroll = false;
@@ -33,14 +39,16 @@ export class Channel {
 
         this.svg.onpointermove = (e) => {
             if (this.selection.active) {
-                this.selection.to = Math.floor(e.offsetX / 25);
+                this.selection.to = this.xToBar(e.offsetX);
                 this.updateSelection();
             }
         };
         this.svg.onpointerdown = (e) => {
+            if (this.song === null) {
+                return;
+            }
             this.selection.active = true;
-            this.selection.from =
-                this.selection.to = Math.floor(e.offsetX / 25);
+            this.selection.from = this.selection.to = this.xToBar(e.offsetX);
             this.updateSelection();
         };
         this.svg.onpointerup = this.svg.onpointerleave = (e) => {
@@ -70,11 +78,94 @@ export class Channel {
 
     }
 
-    setup() {
-        if (this.channel.file !== null) {
-            sck.emit('song_info', this.channel.file, (song) => {
+    /**
+     * Returns the time of a (fractional) bar, extrapolating the bars like
+     * the server (see `Song.bar_to_time`).
+     */
+    barToTime(bar) {
+        let bars = this.song.grid.bars;
+        let i = bar - this.song.grid.first_bar;
+        let j = Math.min(Math.max(Math.floor(i), 0), bars.length - 2);
+        return bars[j] + (i - j) * (bars[j + 1] - bars[j]);
+    }
+
+    /**
+     * Returns the (fractional) bar at a time.
+     */
+    timeToBar(time) {
+        let bars = this.song.grid.bars;
+        // Find the last bar starting before the time
+        let lo = 0, hi = bars.length - 2;
+        while (lo < hi) {
+            let mid = (lo + hi + 1) >> 1;
+            if (bars[mid] <= time) {
+                lo = mid;
+            } else {
+                hi = mid - 1;
+            }
+        }
+        return this.song.grid.first_bar + lo +
+            (time - bars[lo]) / (bars[lo + 1] - bars[lo]);
+    }
+
+    /**
+     * Returns the position of a time on the tape (bar 0 is at `OFF`).
+     */
+    timeToX(time) {
+        return OFF + (time - this.barToTime(0)) * this.t2p;
+    }
+
+    /**
+     * Returns the bar at a position on the tape.
+     */
+    xToBar(x) {
+        return Math.floor(
+            this.timeToBar((x - OFF) / this.t2p + this.barToTime(0)));
+    }
+
+    /**
+     * Draws every other bar and the beats of the song.
+     */
+    drawGrid() {
+        let grid = this.svg.getElementById('grid');
+        grid.replaceChildren();
+        if (this.song === null) {
+            return;
+        }
+        let line = (time, width, opacity) => {
+            let rect = document.createElementNS(SVG_NS, 'rect');
+            rect.setAttribute('x', this.timeToX(time));
+            rect.setAttribute('width', width);
+            rect.setAttribute('height', 80);
+            rect.setAttribute('fill', 'white');
+            rect.setAttribute('opacity', opacity);
+            grid.appendChild(rect);
+        };
+        let bars = this.song.grid.bars;
+        for (let i = 0; i + 1 < bars.length; i++) {
+            if ((this.song.grid.first_bar + i) % 2 === 0) {
+                line(bars[i], (bars[i + 1] - bars[i]) * this.t2p, 0.1);
+            }
+        }
+        for (let beat of this.song.grid.beats) {
+            line(beat, 1, 0.15);
+        }
+    }
+
+    /**
+     * Requests the information about the song of the deck. If `keep`, the
+     * selection is kept (e.g., once the analysis of the song finished).
+     */
+    setup(keep = false) {
+        let file = this.channel.file;
+        if (file !== null) {
+            sck.emit('song_info', file, (song) => {
+                if (this.channel.file !== file) {
+                    // Outdated
+                    return;
+                }
                 this.song = song;
-                this.updateSong();
+                this.updateSong(keep);
             });
         } else {
             this.song = null;
@@ -90,18 +181,19 @@ export class Channel {
         this.updateSelection();
     }
 
-    updateSong() {
-        this.selection.from = null;
-        this.selection.to = null;
-        this.selection.active = false;
-        this.region = null;
-        this.upd('selection', {
-            visibility: 'hidden'
-        });
+    updateSong(keep = false) {
+        if (!keep) {
+            this.selection.from = null;
+            this.selection.to = null;
+            this.selection.active = false;
+            this.region = null;
+        }
 
         $(this.cnt('song-transition')).toggle(this.song !== null);
 
         if (this.song === null) {
+            this.updateSelection();
+            this.drawGrid();
             this.upd('sausage', {width: 0});
             this.upd('cursor', {visibility: 'hidden'});
             return;
@@ -112,16 +204,20 @@ export class Channel {
         this.cnt('song-bpm').innerText = this.song.bpm + ' BPM';
         this.cnt('song-length').innerText = formatTime(this.song.length);
 
+        // 25 pixels per bar (at the average tempo)
         this.t2p = 1 / ((60 / this.song.bpm) / 25 * 4);
+        this.drawGrid();
+        let width = this.song.length * this.t2p;
         this.upd('sausage', {
-            x: -this.song.offset * this.t2p + OFF,
-            width: this.song.length * this.t2p,
-            href: getBlob(this.song.wave_diagram, 'image/svg+xml')
+            x: this.timeToX(0),
+            width: width,
+            href: drawWaveform(this.song.waveform, width, 80).toDataURL()
         });
 
         this.upd('cursor', {
             visibility: 'visible'
         });
+        this.updateSelection();
     }
 
     updateSelection() {
@@ -151,8 +247,10 @@ export class Channel {
 
         this.region = [from, to];
 
+        let x = this.timeToX(this.barToTime(from));
         this.upd('selection', {
-            visibility: 'visible', x: from * 25, width: len * 25
+            visibility: 'visible', x: x,
+            width: this.timeToX(this.barToTime(to + 1)) - x
         });
     }
 
@@ -161,12 +259,11 @@ export class Channel {
             let time = this.channel.time +
                 (new Date().getTime() / 1000 - this.status.stamp);
             // - this.status.stamp) * (this.status.bpm / this.song.bpm) - 1;
-            this.upd('cursor', {x: OFF + time * this.t2p - 15});
+            this.upd('cursor', {x: this.timeToX(time) - 15});
             this.cnt('song-time').innerText = formatTime(time);
 
             if (this.scrollLock) {
-                this.svg.parentElement.scrollTo(1000000 + time * this.t2p - 30,
-                    0);
+                this.svg.parentElement.scrollTo(this.timeToX(time) - 30, 0);
             }
         }
         if (this.channel !== null) {
@@ -183,11 +280,11 @@ export class Channel {
         }
 
         let queued = this.channel.transition_bars;
-        if (queued !== null) {
+        if (queued !== null && this.song !== null) {
+            let x = this.timeToX(this.barToTime(queued[0]));
             this.upd('queued', {
-                visibility: 'visible',
-                x: queued[0] * 25 + 1000000,
-                width: (queued[1] - queued[0] + 1) * 25
+                visibility: 'visible', x: x,
+                width: this.timeToX(this.barToTime(queued[1] + 1)) - x
             });
         } else {
             this.upd('queued', {
@@ -195,7 +292,10 @@ export class Channel {
             });
         }
 
-        if (status.master === ['A', 'B'][this.id]) {
+        // Highlight the master deck and the playing layers
+        if (this.id < MAIN_DECKS ?
+            status.master === String.fromCharCode(65 + this.id) :
+            this.channel.is_playing) {
             this.svg.setAttribute('opacity', 1);
             this.cnt('control').style.setProperty('opacity', 1);
         } else {
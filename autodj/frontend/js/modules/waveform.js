@@ -0,0 +1,53 @@
+/**
+ * Draws the waveform of a song (see `song_info`) on a new canvas of the
+ * given size. The level of the peak pyramid is chosen by the zoom, so the
+ * waveform can be redrawn at any width without asking the server.
+ */
+export function drawWaveform(waveform, width, height, color = 'white') {
+    let canvas = document.createElement('canvas');
+    canvas.width = Math.max(Math.ceil(width), 1);
+    canvas.height = height;
+    if (waveform.data === null) {
+        return canvas;
+    }
+
+    // Use the coarsest level that still has a bin per pixel
+    let level = 0;
+    while (level + 1 < waveform.bins.length &&
+    waveform.bins[level + 1] >= canvas.width) {
+        level++;
+    }
+    let offset = 0;
+    for (let i = 0; i < level; i++) {
+        offset += waveform.bins[i] * 3;
+    }
+    let bins = waveform.bins[level];
+    let signed = new Int8Array(waveform.data, offset, bins * 3);
+    let unsigned = new Uint8Array(waveform.data, offset, bins * 3);
+
+    let ctx = canvas.getContext('2d');
+    ctx.fillStyle = color;
+    let mid = height / 2;
+    let perPixel = bins / canvas.width;
+    for (let x = 0; x < canvas.width; x++) {
+        // Combine all bins of the pixel
+        let from = Math.floor(x * perPixel);
+        let to = Math.max(Math.floor((x + 1) * perPixel), from + 1);
+        let low = 127, high = -127, rms = 0;
+        for (let i = from; i < Math.min(to, bins); i++) {
+            low = Math.min(low, signed[i * 3]);
+            high = Math.max(high, signed[i * 3 + 1]);
+            rms = Math.max(rms, unsigned[i * 3 + 2]);
+        }
+        if (low > high) {
+            continue;
+        }
+        // Peaks translucent, RMS opaque
+        ctx.globalAlpha = 0.5;
+        ctx.fillRect(x, mid - high / 127 * mid, 1,
+            Math.max((high - low) / 127 * mid, 1));
+        ctx.globalAlpha = 1;
+        ctx.fillRect(x, mid - rms / 255 * mid, 1, rms / 255 * height);
+    }
+    return canvas;
+}
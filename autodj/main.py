@@ -1,3 +1,4 @@
+import argparse
 import atexit
 import logging
 from ctypes import *
@@ -11,6 +12,22 @@ def py_error_handler(filename, line, function, err, fmt):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='AutoDJ mixer and server')
+    parser.add_argument('--block-size', type=int, default=Mixer.BUFFER_SIZE,
+        help='number of samples rendered per block')
+    parser.add_argument('--adaptive', action='store_true',
+        help='choose the smallest block size that keeps the margin')
+    parser.add_argument('--margin', type=float, default=0.5,
+        help='fraction of the block duration that must remain unused')
+    parser.add_argument('--channels', type=int, default=2,
+        help='number of channels (decks)')
+    parser.add_argument('--threads', type=int,
+        help='number of threads rendering the channels (default: one per '
+             'channel)')
+    parser.add_argument('--metrics-file',
+        help='file to append the render metrics of every block to')
+    args = parser.parse_args()
+
     # Disable messages by PyAudio
     ERROR_HANDLER_FUNC = CFUNCTYPE(None, c_char_p, c_int, c_char_p, c_int,
         c_char_p)
@@ -25,12 +42,14 @@ if __name__ == "__main__":
 
     # Start mixer and server
     logging.info('Initializing mixer')
-    mix = Mixer()
+    mix = Mixer(block_size=args.block_size, adaptive=args.adaptive,
+        margin=args.margin, metrics_file=args.metrics_file,
+        num_channels=args.channels, threads=args.threads)
 
 
     # Kill the mixer on exit
     def exit_handler():
-        mix.stream.stop_stream()
+        mix.close()
 
 
     atexit.register(exit_handler)
@@ -0,0 +1,135 @@
+import argparse
+import json
+import logging
+import subprocess
+import time
+from typing import List
+
+from autodj.backend.audio import AudioFile
+from autodj.backend.fsm import TargetChannel, MixerStage
+from autodj.backend.mixer import Mixer
+from autodj.backend.song import Song
+from autodj.backend.transitions import load_transition
+
+# Interval in which the progress is logged (in seconds of audio)
+PROGRESS_INTERVAL = 60
+
+
+class SetRenderer:
+    """
+    Renders a set (i.e., a playlist with queued transitions) to a file as
+    fast as possible. The mixer is driven without an audio stream and the
+    output is encoded by ffmpeg (the format is given by the file extension).
+
+    Every entry of the set contains the `file` of the song, the "in"
+    `transition` (a transition file) and the `bars` of the song the
+    transition is applied to. All but the first entry additionally contain
+    the bars `from` of the previous song, during which it fades out.
+    """
+
+    def __init__(self, entries: List[dict], out_file: str,
+            bpm: float = None, block_size: int = Mixer.BUFFER_SIZE):
+        self.entries = entries
+        self.out_file = out_file
+        self.mixer = Mixer(block_size=block_size, stream=False,
+            lookahead=False)
+
+        # Decode and analyze all songs completely, since rendering is faster
+        # than decoding (and the tempo maps must not change while rendering)
+        logging.info(f'Loading {len(entries)} songs')
+        self.songs = []
+        for entry in entries:
+            song = Song(entry['file'])
+            song.analyzed.wait()
+            self.songs.append(song)
+
+        self.mixer.global_bpm = bpm if bpm is not None else self.songs[0].bpm
+        self.rendered = 0
+
+    def _produce(self):
+        self.proc.stdin.write(self.mixer.produce().tobytes())
+        self.rendered += self.mixer.block_size
+        seconds = self.rendered / AudioFile.SAMPLE_RATE
+        if seconds % PROGRESS_INTERVAL < self.mixer.block_size / \
+                AudioFile.SAMPLE_RATE:
+            logging.info(f'Rendered {seconds / 60:.0f} minutes')
+
+    def _queue(self, index: int):
+        """
+        Loads the song of the entry and queues its transition, each once the
+        FSM allows it (i.e., the previous transition has finished).
+        """
+        fsm = self.mixer.fsm
+        song = self.songs[index]
+        while fsm.load(song, dry=True) == TargetChannel.INVALID:
+            self._produce()
+        fsm.load(song)
+        while fsm.queue(None, dry=True) == MixerStage.INVALID:
+            self._produce()
+
+        entry = self.entries[index]
+        _, trans = load_transition(entry['transition'],
+            self.mixer.all_effects)
+        # The previous song (in the source channel) fades out with the
+        # inverted transition
+        stage = fsm.queue(None, dry=True)
+        selections = [None] * len(self.mixer.channels)
+        selections[stage.dst] = entry['bars']
+        if stage.src is not None:
+            selections[stage.src] = entry.get('from')
+        fsm.queue(fsm.create_queue_data([trans] * len(selections),
+            selections))
+        logging.info(f'Queued {song.file}')
+
+    def render(self):
+        """
+        Renders the set and returns the render speed as multiple of real
+        time.
+        """
+        self.proc = subprocess.Popen(
+            ['ffmpeg', '-y', '-f', 'f32le', '-ar', str(AudioFile.SAMPLE_RATE),
+             '-ac', '2', '-i', 'pipe:0', self.out_file],
+            stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        start = time.perf_counter()
+        try:
+            for i in range(len(self.entries)):
+                self._queue(i)
+
+            # Render until the last song ends
+            last = self.songs[-1]
+            channel = next(c for c in self.mixer.channels if c.song is last)
+            while channel.is_playing and channel.song is last and \
+                    channel.time * AudioFile.SAMPLE_RATE < last.length:
+                self._produce()
+        finally:
+            self.mixer.close()
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                raise subprocess.CalledProcessError(self.proc.returncode,
+                    'ffmpeg')
+        elapsed = time.perf_counter() - start
+
+        return self.rendered / AudioFile.SAMPLE_RATE / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Renders a set of the AutoDJ mixer to a file')
+    parser.add_argument('set', help='set file (JSON)')
+    parser.add_argument('output', help='output file (e.g., .wav or .flac)')
+    parser.add_argument('--block-size', type=int, default=Mixer.BUFFER_SIZE,
+        help='number of samples rendered per block')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+        format="(%(asctime)s) [%(levelname)s] %(message)s", datefmt='%H:%M:%S')
+
+    with open(args.set) as j:
+        js = json.load(j)
+
+    renderer = SetRenderer(js['songs'], args.output, js.get('bpm'),
+        args.block_size)
+    speed = renderer.render()
+    logging.info(f'Rendered {renderer.rendered / AudioFile.SAMPLE_RATE:.1f} '
+                 f'seconds at {speed:.1f}x real-time')